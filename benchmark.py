@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import math
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import traceback
+import contextlib
+import multiprocessing
+import queue
+
+import vcontrol
+
+
+def read_proc_io():
+    # Linux only; other platforms report no I/O counters
+    try:
+        with open('/proc/self/io', 'r') as f:
+            return dict((key, int(value)) for key, value in (line.split(': ') for line in f))
+    except OSError:
+        return None
+
+
+def run_measured(repo_dir, operation, args, results):
+    os.chdir(repo_dir)
+    io_before = read_proc_io()
+    start = time.perf_counter()
+    status = 'ok'
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            operation(*args)
+        except SystemExit as exception:
+            if exception.code not in (None, 0):
+                status = 'exit {}'.format(exception.code)
+        except Exception as exception:
+            # reported rather than raised, so a regression shows up in the results instead of hanging them
+            traceback.print_exc()
+            status = 'error: {}: {}'.format(type(exception).__name__, exception)
+    wall_time = time.perf_counter() - start
+    io_after = read_proc_io()
+
+    result = {
+        'status': status,
+        'wall_time': wall_time,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+    if io_before is not None and io_after is not None:
+        result['read_bytes'] = io_after['rchar'] - io_before['rchar']
+        result['write_bytes'] = io_after['wchar'] - io_before['wchar']
+        result['read_syscalls'] = io_after['syscr'] - io_before['syscr']
+        result['write_syscalls'] = io_after['syscw'] - io_before['syscw']
+    results.put(result)
+
+
+def measure(repo_dir, name, operation, *args):
+    # every operation runs in a fresh interpreter, so module caches and peak RSS are per operation
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_measured, args=(repo_dir, operation, args, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            # a child killed outright never reports back
+            if not process.is_alive():
+                try:
+                    result = results.get(timeout=1)
+                except queue.Empty:
+                    result = {'status': 'died with exit code {}'.format(process.exitcode), 'wall_time': 0.0, 'peak_rss_kb': 0}
+                break
+    process.join()
+    result['op'] = name
+    return result
+
+
+def create_operation(repo_name, username):
+    vcontrol.create_command(argparse.Namespace(repo_name=repo_name, username=username, storage_mode='copy'))
+
+
+def commit_operation(jobs):
+    vcontrol.commit_command(argparse.Namespace(ignore=[], jobs=jobs))
+
+
+def info_operation():
+    vcontrol.info_command(argparse.Namespace())
+
+
+def revert_operation(commit_tag):
+    vcontrol.revert(commit_tag, vcontrol.WORKING_DIR, vcontrol.COMMITS_PATH)
+
+
+def fetch_operation(target_dir):
+    vcontrol.fetch_command(argparse.Namespace(dir=target_dir, revert=False, depth=None, lazy=False, check=False))
+
+
+def random_size(rng, min_size, max_size):
+    # log-uniform, so most files are small with a long tail of large ones
+    return int(math.exp(rng.uniform(math.log(max(min_size, 1)), math.log(max(max_size, 1)))))
+
+
+def generate_paths(rng, file_count, depth, fanout):
+    paths = []
+    for number in range(file_count):
+        parts = ['dir{}'.format(rng.randrange(fanout)) for _ in range(rng.randint(0, depth))]
+        paths.append(os.path.join(*(parts + ['file{}.dat'.format(number)])))
+    return paths
+
+
+def write_file(path, size, rng):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(rng.getrandbits(8 * size).to_bytes(size, 'little') if size else b'')
+
+
+def summarize(results):
+    summary = {}
+    for result in results:
+        entry = summary.setdefault(result['op'], {'count': 0, 'wall_time_total': 0.0, 'wall_time_max': 0.0, 'peak_rss_kb_max': 0})
+        entry['count'] += 1
+        entry['wall_time_total'] += result['wall_time']
+        entry['wall_time_max'] = max(entry['wall_time_max'], result['wall_time'])
+        entry['peak_rss_kb_max'] = max(entry['peak_rss_kb_max'], result['peak_rss_kb'])
+        for key in ['read_bytes', 'write_bytes']:
+            if key in result:
+                entry[key + '_total'] = entry.get(key + '_total', 0) + result[key]
+    for entry in summary.values():
+        entry['wall_time_mean'] = entry['wall_time_total'] / entry['count']
+    return summary
+
+
+def run_benchmark(args):
+    rng = random.Random(args.seed)
+    work_dir = os.path.abspath(tempfile.mkdtemp(prefix='vcontrol-bench-', dir=args.work_dir))
+    source_dir = os.path.join(work_dir, 'source')
+    clone_dir = os.path.join(work_dir, 'clone')
+    os.makedirs(source_dir)
+    os.makedirs(clone_dir)
+
+    results = []
+    try:
+        results.append(measure(source_dir, 'create', create_operation, 'bench', 'bench'))
+
+        paths = generate_paths(rng, args.files, args.depth, args.fanout)
+        for path in paths:
+            write_file(os.path.join(source_dir, path), random_size(rng, args.min_size, args.max_size), rng)
+        result = measure(source_dir, 'commit', commit_operation, args.jobs)
+        result['commit'] = 1
+        results.append(result)
+
+        changed_count = max(1, int(math.ceil(args.churn * len(paths))))
+        for number in range(2, args.commits + 1):
+            for path in rng.sample(paths, min(changed_count, len(paths))):
+                write_file(os.path.join(source_dir, path), random_size(rng, args.min_size, args.max_size), rng)
+            results.append(measure(source_dir, 'info', info_operation))
+            result = measure(source_dir, 'commit', commit_operation, args.jobs)
+            result['commit'] = number
+            results.append(result)
+
+        results.append(measure(source_dir, 'info', info_operation))
+        results.append(measure(source_dir, 'revert', revert_operation, vcontrol.format_commit_tag(1, 'bench')))
+        results.append(measure(source_dir, 'revert', revert_operation, vcontrol.format_commit_tag(args.commits, 'bench')))
+
+        results.append(measure(clone_dir, 'create', create_operation, 'clone', 'clone'))
+        results.append(measure(clone_dir, 'fetch', fetch_operation, source_dir))
+        results.append(measure(clone_dir, 'fetch', fetch_operation, source_dir))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'params': vars(args),
+        'work_dir': work_dir if args.keep else None,
+        'results': results,
+        'summary': summarize(results)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='benchmark',
+        description='Times vcontrol commands against a generated repository and reports JSON.'
+    )
+    parser.add_argument('-f', '--files', dest='files', type=int, help='Number of files in the repository.', default=1000)
+    parser.add_argument('-d', '--depth', dest='depth', type=int, help='Maximum directory depth.', default=3)
+    parser.add_argument('--fanout', dest='fanout', type=int, help='Directories per level.', default=8)
+    parser.add_argument('--min-size', dest='min_size', type=int, help='Smallest file size in bytes.', default=64)
+    parser.add_argument('--max-size', dest='max_size', type=int, help='Largest file size in bytes.', default=256 * 1024)
+    parser.add_argument('-c', '--commits', dest='commits', type=int, help='Number of commits to make.', default=5)
+    parser.add_argument('--churn', dest='churn', type=float, help='Fraction of files rewritten per commit.', default=0.05)
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, help='Jobs passed to commit.', default=vcontrol.DEFAULT_JOBS)
+    parser.add_argument('--seed', dest='seed', type=int, help='Random seed for the generated repository.', default=317)
+    parser.add_argument('--work-dir', dest='work_dir', type=str, help='Directory to generate repositories in.', default=None)
+    parser.add_argument('--keep', dest='keep', action='store_true', help='Keeps the generated repositories.', default=False)
+    parser.add_argument('-o', '--output', dest='output', type=str, help='Writes the JSON report to a file instead of stdout.', default=None)
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+VCONTROL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'vcontrol.py')
+
+
+def vcontrol(cwd, *args, stdin=None):
+    return subprocess.run([sys.executable, VCONTROL] + list(args), cwd=cwd, input=stdin,
+                          capture_output=True, text=True)
+
+
+class ShallowFetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='vcontrol-test-')
+        self.source = os.path.join(self.dir, 'a')
+        self.clone = os.path.join(self.dir, 'b')
+        os.makedirs(self.source)
+        os.makedirs(self.clone)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_shallow_fetch_after_incremental_repacks(self):
+        # the second pack stores f as a delta against its version in the first pack
+        vcontrol(self.source, 'create', 'a', 'alice')
+        with open(os.path.join(self.source, 'f'), 'w') as f:
+            f.write(''.join('{}\n'.format(number) for number in range(5000)))
+        self.assertEqual(vcontrol(self.source, 'commit').returncode, 0)
+        vcontrol(self.source, 'repack')
+        with open(os.path.join(self.source, 'f'), 'a') as f:
+            f.write('x\n')
+        self.assertEqual(vcontrol(self.source, 'commit').returncode, 0)
+        self.assertIn('1 stored as deltas', vcontrol(self.source, 'repack').stdout)
+
+        vcontrol(self.clone, 'create', 'b', 'bob')
+        self.assertEqual(vcontrol(self.clone, 'fetch', self.source, '--depth', '1').returncode, 0)
+        fsck = vcontrol(self.clone, 'fsck')
+        self.assertEqual(fsck.returncode, 0, fsck.stdout)
+        revert = vcontrol(self.clone, 'revert', 'V00002_alice', stdin='y\n')
+        self.assertEqual(revert.returncode, 0, revert.stdout + revert.stderr)
+        with open(os.path.join(self.clone, 'f')) as f:
+            self.assertTrue(f.read().endswith('4999\nx\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,26 +3,191 @@ import sys
 import errno
 import json
 import shutil
+import hashlib
+import zlib
+import mmap
+import struct
 import filecmp
+import random
 import argparse
+import functools
+import contextlib
+import urllib.parse
+import time
+import heapq
+import fcntl
+import threading
+import re
+import fnmatch
+import socket
+import io
+import glob
+import collections
+# asyncio, concurrent.futures, ctypes, tarfile, zipfile and uuid are imported by the commands that
+# use them, so a command forwarded to the daemon starts without loading them
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 WORKING_DIR = "."
 VCS_PATH = WORKING_DIR + "/.vcs"
 CONFIG_PATH = VCS_PATH + "/config.json"
 COMMITS_PATH = VCS_PATH + "/commits"
-
-
-def main():
+OBJECTS_PATH = VCS_PATH + "/objects"
+PACKS_PATH = OBJECTS_PATH + "/pack"
+INDEX_PATH = VCS_PATH + "/index.json"
+COMMIT_GRAPH_PATH = VCS_PATH + "/commit-graph.json"
+DAEMON_SOCKET_PATH = VCS_PATH + "/daemon.sock"
+MONITOR_SOCKET_PATH = VCS_PATH + "/monitor.sock"
+MONITOR_STATE_PATH = VCS_PATH + "/monitor.json"
+PRUNED_PATH = VCS_PATH + "/pruned"
+SHALLOW_PATH = VCS_PATH + "/shallow"
+LOCK_PATH = VCS_PATH + "/lock"
+SPARSE_CHECKOUT_PATH = VCS_PATH + "/sparse-checkout"
+IGNORE_PATH = WORKING_DIR + "/.vcontrolignore"
+
+BLOCK_SIZE = 64 * 1024
+PACK_MAGIC = b'VPCK'
+PACK_INDEX_MAGIC = b'VIDX'
+PACK_VERSION = 1
+PACK_INDEX_HEADER = struct.Struct('>4sII')
+PACK_INDEX_RECORD = struct.Struct('>20sQQ')
+PACK_BLOB = b'\x00'
+PACK_DELTA = b'\x01'
+DELTA_COPY = b'C'
+DELTA_INSERT = b'I'
+DELTA_BLOCK_SIZE = 16
+DELTA_SKIP_AFTER = 1024
+DELTA_MAX_SIZE = 128 * 1024 * 1024
+DEFAULT_MAX_DELTA_DEPTH = 10
+FICLONE = 0x40049409
+STORAGE_MODES = ['copy', 'hardlink']
+WIRE_CHUNK = struct.Struct('>I')
+WIRE_LINE_LIMIT = 64 * 1024 * 1024
+WIRE_BATCH_SIZE = 1000
+OBJECT_HASH_PATTERN = re.compile(r'[0-9a-f]{40}')
+COMMIT_TAG_PATTERN = re.compile(r'V[0-9]{5,}_[^/\x00]+')
+DEFAULT_CHUNK_THRESHOLD = 8 * 1024 * 1024
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_WINDOW = 32
+CHUNK_SCAN_BLOCK = 64 * 1024
+DEFAULT_PORT = 7317
+DEFAULT_JOBS = os.cpu_count() or 1
+DAEMON_COMMANDS = ['info', 'log', 'diff']
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+INOTIFY_EVENT = struct.Struct('iIII')
+DEFAULT_POLL_INTERVAL = 2.0
+GC_GRACE_SECONDS = 60 * 60
+DIFF_BINARY_PROBE = 8000
+DIFF_MAX_COST = 1000
+EXPORT_FORMATS = ['tar', 'tar.gz', 'tar.zst', 'zip']
+BATCH_COMMANDS = ['info', 'commit', 'fetch']
+TREE_CACHE_SIZE = 16384
+COMMIT_CACHE_SIZE = 1024
+MANIFEST_CACHE_SIZE = 4
+
+
+_profile = None
+_profile_lock = threading.Lock()
+
+
+def enable_profiling():
+    global _profile
+    _profile = {'start': time.perf_counter(), 'phases': {}, 'counters': {}, 'events': []}
+
+
+@contextlib.contextmanager
+def profile_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        with _profile_lock:
+            phase = _profile['phases'].setdefault(name, {'calls': 0, 'seconds': 0.0})
+            phase['calls'] += 1
+            phase['seconds'] += end - start
+            _profile['events'].append({
+                'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                'ts': (start - _profile['start']) * 1e6, 'dur': (end - start) * 1e6
+            })
+
+
+def profiled(name):
+    # when profiling is off the only cost is one global lookup per call
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profile is None:
+                return func(*args, **kwargs)
+            with profile_phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, amount=1):
+    if _profile is None:
+        return
+    with _profile_lock:
+        _profile['counters'][name] = _profile['counters'].get(name, 0) + amount
+
+
+def report_profile(summary, trace_path):
+    total = time.perf_counter() - _profile['start']
+    counters = _profile['counters']
+    for name in ['index', 'manifest cache', 'tree cache']:
+        lookups = counters.get(name + ' hits', 0) + counters.get(name + ' misses', 0)
+        if lookups:
+            counters[name + ' hit rate'] = round(counters.get(name + ' hits', 0) / lookups, 4)
+
+    if summary:
+        print('profile: {:.3f}s total'.format(total), file=sys.stderr)
+        for name, phase in sorted(_profile['phases'].items(), key=lambda item: -item[1]['seconds']):
+            print('  {:<28} {:>8} call(s) {:>10.3f}s'.format(name, phase['calls'], phase['seconds']), file=sys.stderr)
+        for name, value in sorted(counters.items()):
+            print('  {:<28} {:>20}'.format(name, value), file=sys.stderr)
+
+    if trace_path:
+        events = list(_profile['events'])
+        events.append({'name': 'counters', 'ph': 'C', 'pid': os.getpid(), 'ts': total * 1e6,
+                       'args': dict((name, value) for name, value in counters.items())})
+        with open(trace_path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def build_parser():
     parser = argparse.ArgumentParser(
         prog='vcontrol',
         description='vcontrol is a demo version control system for COEN 317, Distributed Computing.'
     )
+    parser.add_argument('--profile', dest='profile', action='store_true', help='Prints per-phase timings and counters to stderr. Set VCONTROL_TRACE=file to also write a Chrome trace.', default=False)
     subparsers = parser.add_subparsers(title='command list', metavar='action')
 
     parser_create = subparsers.add_parser('create', help='Initializes a new vcontrol repository as the current directory.')
     parser_create.add_argument('repo_name', type=str, help='Specified name the vcontrol repo.')
     parser_create.add_argument('username', type=str, help='Specified username for the vcontrol repo.')
+    parser_create.add_argument('-s', '--storage-mode', dest='storage_mode', choices=STORAGE_MODES, help='copy (reflink when supported) or hardlink read-only objects into the working directory.', default='copy')
     parser_create.set_defaults(func=create_command)
 
     parser_info = subparsers.add_parser('info', help='Shows information regarding the status of the current repository.')
@@ -30,22 +195,126 @@ def main():
 
     parser_commit = subparsers.add_parser('commit', help='Commits changes in the current repository.')
     parser_commit.add_argument('-i', '--ignore', dest='ignore', nargs='*', help='Ignores file(s) for commit.', default=[])
+    parser_commit.add_argument('-j', '--jobs', dest='jobs', type=int, help='Number of files hashed and stored concurrently.', default=DEFAULT_JOBS)
     parser_commit.set_defaults(func=commit_command)
 
     parser_fetch = subparsers.add_parser('fetch', help='Fetches commits from a specified repository.')
-    parser_fetch.add_argument('dir', type=str, help='Directory of target repository to fetch commits from.')
+    parser_fetch.add_argument('dir', type=str, help='Directory of target repository, or tcp://host:port of a vcontrol server, to fetch commits from.')
     parser_fetch.add_argument('-rl', '--revert-latest', dest='revert', action='store_true', help='Loads the target repository latest commit on fetch.', default=False)
+    parser_fetch.add_argument('--depth', dest='depth', type=int, help='Only fetches the target latest commit and its ancestors up to N - 1 parents back.', default=None)
+    parser_fetch.add_argument('--lazy', dest='lazy', action='store_true', help='Fetches commits and trees only; file contents are downloaded from the target when first read.', default=False)
+    parser_fetch.add_argument('--check', dest='check', action='store_true', help='Verifies the received objects before the fetch is recorded.', default=False)
     parser_fetch.set_defaults(func=fetch_command)
 
+    parser_serve = subparsers.add_parser('serve', help='Serves this repository to fetching peers over TCP.')
+    parser_serve.add_argument('--host', dest='host', type=str, help='Address to listen on.', default='127.0.0.1')
+    parser_serve.add_argument('-p', '--port', dest='port', type=int, help='Port to listen on.', default=DEFAULT_PORT)
+    parser_serve.set_defaults(func=serve_command)
+
     parser_revert = subparsers.add_parser('revert', help='Reverts the working directory back to a previous commit stage.')
     parser_revert.add_argument('commit_tag', type=str, help='Specified vcontrol commit to revert the project to.')
+    parser_revert.add_argument('paths', nargs='*', help='Only restores these files or directories, e.g. revert V00003_alice -- src/ setup.cfg', default=[])
     parser_revert.set_defaults(func=revert_command)
 
-    if len(sys.argv) == 1:
+    parser_log = subparsers.add_parser('log', help='Lists the commit history, optionally only commits touching a path.')
+    parser_log.add_argument('path', type=str, nargs='?', help='Only lists commits that changed this file or directory.', default=None)
+    parser_log.add_argument('-a', '--all', dest='all', action='store_true', help='Lists every known commit, including fetched ones.', default=False)
+    parser_log.add_argument('-n', '--max-count', dest='max_count', type=int, help='Maximum number of commits to list.', default=None)
+    parser_log.set_defaults(func=log_command)
+
+    parser_diff = subparsers.add_parser('diff', help='Shows line changes between two commits, or between a commit and the working directory.')
+    parser_diff.add_argument('args', nargs='*', metavar='commit_or_path', help='Up to two commit tags, defaulting to the current commit against the working directory, then files or directories to limit the diff to.')
+    parser_diff.add_argument('-U', '--unified', dest='context', type=int, help='Number of context lines around each change.', default=3)
+    parser_diff.set_defaults(func=diff_command)
+
+    parser_export = subparsers.add_parser('export', help='Writes the files of a commit to a tar or zip archive without touching the working directory.')
+    parser_export.add_argument('commit_tag', type=str, help='Specified vcontrol commit to export.')
+    parser_export.add_argument('paths', nargs='*', help='Only exports these files or directories.', default=[])
+    parser_export.add_argument('-o', '--output', dest='output', type=str, help='Archive to write, or - for stdout.', default='-')
+    parser_export.add_argument('-f', '--format', dest='format', choices=EXPORT_FORMATS, help='Archive format, by default taken from the output file extension, else tar.', default=None)
+    parser_export.set_defaults(func=export_command)
+
+    parser_repack = subparsers.add_parser('repack', help='Packs loose objects into a compressed pack file.')
+    parser_repack.add_argument('-a', '--all', dest='all', action='store_true', help='Also consolidates existing pack files into the new pack.', default=False)
+    parser_repack.add_argument('-d', '--depth', dest='depth', type=int, help='Maximum delta chain length, defaults to the repository config. With --all, rewrites existing packs to it.', default=None)
+    parser_repack.set_defaults(func=repack_command)
+
+    parser_gc = subparsers.add_parser('gc', help='Prunes old commits and removes objects no kept commit references.')
+    parser_gc.add_argument('-k', '--keep', dest='keep', type=int, help='Keeps only the N most recent commits.', default=None)
+    parser_gc.add_argument('--since', dest='since', type=str, help='Keeps only commits newer than a date (YYYY-MM-DD[ HH:MM[:SS]]) or an age (12h, 30d, 2w).', default=None)
+    parser_gc.add_argument('--prune-now', dest='prune_now', action='store_true', help='Also removes unreferenced data less than an hour old.', default=False)
+    parser_gc.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', help='Only lists what would be removed.', default=False)
+    parser_gc.add_argument('-j', '--jobs', dest='jobs', type=int, help='Number of commits marked concurrently.', default=DEFAULT_JOBS)
+    parser_gc.set_defaults(func=gc_command)
+
+    parser_fsck = subparsers.add_parser('fsck', help='Verifies that every commit is complete and every stored object matches its hash.')
+    parser_fsck.add_argument('-j', '--jobs', dest='jobs', type=int, help='Number of objects verified concurrently.', default=DEFAULT_JOBS)
+    parser_fsck.add_argument('--progress', dest='progress', action='store_true', help='Reports progress on stderr, the default on a terminal.', default=None)
+    parser_fsck.add_argument('--no-progress', dest='progress', action='store_false', help='Does not report progress.', default=None)
+    parser_fsck.set_defaults(func=fsck_command)
+
+    parser_batch = subparsers.add_parser('batch', help='Runs info, commit or fetch in many repositories at once, printing one JSON line per repository.')
+    parser_batch.add_argument('batch_command', choices=BATCH_COMMANDS, help='Command to run in every repository.')
+    parser_batch.add_argument('--repos-from', dest='repos_from', type=str, required=True, help='File listing repository directories one per line, - for stdin, or a glob such as "repos/*".')
+    parser_batch.add_argument('-j', '--jobs', dest='jobs', type=int, help='Number of repositories processed concurrently.', default=DEFAULT_JOBS)
+    parser_batch.add_argument('args', nargs='*', help='Arguments for the command, e.g. batch fetch --repos-from repos.txt -- tcp://host:7317 --check', default=[])
+    parser_batch.set_defaults(func=batch_command)
+
+    parser_daemon = subparsers.add_parser('daemon', help='Keeps this repository loaded and answers info and log requests over a Unix socket.')
+    parser_daemon.add_argument('--stop', dest='stop', action='store_true', help='Stops a running daemon.', default=False)
+    parser_daemon.set_defaults(func=daemon_command)
+
+    parser_monitor = subparsers.add_parser('monitor', help='Watches the working directory so info and commit only look at changed paths.')
+    parser_monitor.add_argument('--stop', dest='stop', action='store_true', help='Stops a running monitor.', default=False)
+    parser_monitor.add_argument('--poll', dest='poll', action='store_true', help='Polls for changes instead of using inotify.', default=False)
+    parser_monitor.add_argument('--interval', dest='interval', type=float, help='Seconds between scans when polling.', default=DEFAULT_POLL_INTERVAL)
+    parser_monitor.set_defaults(func=monitor_command)
+
+    return parser
+
+
+def parse_command_line(parser, argv):
+    args, extra = parser.parse_known_args(argv)
+    if extra and getattr(args, 'func', None) is not batch_command:
+        parser.error('unrecognized arguments: {}'.format(' '.join(extra)))
+    if extra:
+        # the arguments batch does not know belong to the command it runs
+        if extra[0] == '--':
+            extra = extra[1:]
+        args.args = args.args + extra
+    return args
+
+
+def run_command(args):
+    global _profile
+    trace_path = os.environ.get('VCONTROL_TRACE')
+    if args.profile or trace_path:
+        enable_profiling()
+        try:
+            args.func(args)
+        finally:
+            report_profile(args.profile, trace_path)
+            _profile = None
+    else:
+        args.func(args)
+
+
+def main():
+    argv = sys.argv[1:]
+    # checked before the parser is built, so a forwarded command only pays for the round trip
+    if argv and argv[0] in DAEMON_COMMANDS and os.path.exists(DAEMON_SOCKET_PATH) \
+            and not os.environ.get('VCONTROL_TRACE'):
+        try:
+            sys.exit(forward_to_daemon(argv))
+        except OSError:
+            # a stale socket or a daemon that went away, so just run locally
+            pass
+
+    parser = build_parser()
+    if not argv:
         parser.print_help(sys.stderr)
         sys.exit(1)
-    args = parser.parse_args()
-    args.func(args)
+    run_command(parse_command_line(parser, argv))
 
 
 def write_json(data, filePointer):
@@ -53,8 +322,51 @@ def write_json(data, filePointer):
 
 
 def write_json_file(filename, data):
-    with open(filename, 'w') as f:
+    # written beside the target and renamed over it, so readers and crashes only ever see a whole file
+    tmp = '{}.tmp{}-{}'.format(filename, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as f:
         json.dump(data, f, indent=4,)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+    fsync_directory(os.path.dirname(filename) or '.')
+
+
+def fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def publish_directory(tmp, dst):
+    # a directory rename is atomic and fails if dst already has contents, so nobody sees half a commit
+    try:
+        os.rename(tmp, dst)
+    except OSError as exception:
+        if exception.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+            raise
+        shutil.rmtree(tmp)
+        return False
+    fsync_directory(os.path.dirname(dst))
+    return True
+
+
+@contextlib.contextmanager
+def repository_lock():
+    # taken by commands that change history or the working tree; readers such as info and log never
+    # take it and rely on every file being replaced atomically instead
+    with open(LOCK_PATH, 'a') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print('Waiting for another vcontrol process to release {}...'.format(LOCK_PATH), file=sys.stderr)
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
 
 def read_json(filePointer):
@@ -76,104 +388,2046 @@ def update_config_file(config_dict):
     write_json_file(CONFIG_PATH, config_dict)
 
 
-def get_file_paths(starting_directory, to_ignore):
-    file_paths = []
-    for dirpath, dirnames, filenames in os.walk(starting_directory, topdown=True):
-        dirnames[:] = [d for d in dirnames if d not in to_ignore]
-        for filename in filenames:
-            file_paths.append(os.path.join(dirpath, filename))
-    return file_paths
+def hash_file(filename):
+    sha = hashlib.sha1()
+    size = 0
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            sha.update(block)
+            size += len(block)
+    count('files hashed')
+    count('bytes read', size)
+    return sha.hexdigest()
+
+
+def object_path(object_hash, objects_path=OBJECTS_PATH):
+    return '{}/{}/{}'.format(objects_path, object_hash[:2], object_hash[2:])
+
+
+def has_object(object_hash, objects_path=OBJECTS_PATH):
+    return os.path.exists(object_path(object_hash, objects_path)) \
+        or find_packed_object(object_hash, objects_path) is not None
+
+
+_copy_methods = {}
+
+
+def copy_file(src, dst):
+    # try a reflink first, then an in-kernel copy, and remember per device pair what worked
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        devices = (os.fstat(fsrc.fileno()).st_dev, os.fstat(fdst.fileno()).st_dev)
+        count('bytes written', os.fstat(fsrc.fileno()).st_size)
+        method = _copy_methods.get(devices, 'reflink')
+        if method == 'reflink':
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                _copy_methods[devices] = 'reflink'
+                return
+            except OSError:
+                method = 'copy_file_range'
+        if method == 'copy_file_range' and hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30) > 0:
+                    pass
+                _copy_methods[devices] = 'copy_file_range'
+                return
+            except OSError:
+                # both offsets have moved past what was copied, so start over from the beginning
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        _copy_methods[devices] = 'copyfileobj'
+        shutil.copyfileobj(fsrc, fdst, BLOCK_SIZE)
+
+
+def link_file(src, dst):
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        return False
+
+
+def store_object(filename, object_hash=None, objects_path=OBJECTS_PATH):
+    # objects are keyed by content, so anything already stored is never written twice
+    if object_hash is None:
+        object_hash = hash_file(filename)
+    if has_object(object_hash, objects_path):
+        count('objects deduplicated')
+        return object_hash
+    count('objects written')
+    dst = object_path(object_hash, objects_path)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = '{}.tmp{}_{}'.format(dst, os.getpid(), threading.get_ident())
+    # always a copy or reflink: a working file linked in here could later be edited in place
+    copy_file(filename, tmp)
+    # objects are immutable; read-only also protects them when hardlinked into the tree on checkout
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, dst)
+    return object_hash
+
+
+def copy_object(object_hash, dst, objects_path=OBJECTS_PATH, link=False):
+    src = object_path(object_hash, objects_path)
+    if not os.path.exists(src) and find_packed_object(object_hash, objects_path) is None:
+        fetch_missing_objects([object_hash], objects_path)
+    if os.path.exists(src):
+        if not (link and link_file(src, dst)):
+            copy_file(src, dst)
+        return
+    with open(dst, 'wb') as f:
+        for block in iter_packed_object(object_hash, objects_path):
+            f.write(block)
+
+
+def fetch_object(object_hash, src_objects_path, objects_path=OBJECTS_PATH):
+    src = object_path(object_hash, src_objects_path)
+    if os.path.exists(src):
+        return store_object(src, object_hash, objects_path)
+    dst = object_path(object_hash, objects_path)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = '{}.tmp{}_{}'.format(dst, os.getpid(), threading.get_ident())
+    copy_object(object_hash, tmp, src_objects_path)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, dst)
+    return object_hash
+
+
+def copy_packs(object_hashes, src_objects_path, objects_path=OBJECTS_PATH):
+    # packs are named after their contents, so a pack with a known name is already here
+    os.makedirs(objects_path + '/pack', exist_ok=True)
+    local_names = set(os.listdir(objects_path + '/pack'))
+    keys = [bytes.fromhex(object_hash) for object_hash in object_hashes]
+    src_packs = load_packs(src_objects_path)
+    selected = [pack for pack in src_packs if pack['name'] + '.idx' not in local_names
+                and any(find_in_pack(pack, key) is not None for key in keys)]
+
+    # a delta may be stored against a base in an older pack, or in none, and the base has to come along
+    pending = list(selected)
+    loose_bases = set()
+    while pending:
+        for base_hash in pack_delta_bases(pending.pop()):
+            key = bytes.fromhex(base_hash)
+            if any(find_in_pack(pack, key) is not None for pack in selected) or has_object(base_hash, objects_path):
+                continue
+            holder = next((pack for pack in src_packs if find_in_pack(pack, key) is not None), None)
+            if holder is None:
+                loose_bases.add(base_hash)
+            else:
+                selected.append(holder)
+                pending.append(holder)
+    for base_hash in loose_bases:
+        fetch_object(base_hash, src_objects_path, objects_path)
+
+    copied = []
+    for pack in selected:
+        # until the fetch publishes its commits nothing references the pack, and the .keep file
+        # stops gc from dropping it in the meantime
+        with open(keep_pack_path(pack['name'], objects_path), 'w'):
+            pass
+        for extension in ['.pack', '.idx']:
+            dst = '{}/pack/{}{}'.format(objects_path, pack['name'], extension)
+            tmp = '{}.tmp{}'.format(dst, os.getpid())
+            copy_file('{}/pack/{}{}'.format(src_objects_path, pack['name'], extension), tmp)
+            os.replace(tmp, dst)
+        copied.append(pack['name'])
+    if copied:
+        forget_packs(objects_path)
+    return copied
+
+
+def pack_delta_bases(pack):
+    for position in range(pack['count']):
+        _, offset, _ = pack_index_record(pack, position)
+        if pack['pack'][offset:offset + 1] == PACK_DELTA:
+            yield pack['pack'][offset + 1:offset + 21].hex()
+
+
+def keep_pack_path(name, objects_path=OBJECTS_PATH):
+    return '{}/pack/{}.keep'.format(objects_path, name)
+
+
+def release_packs(names, objects_path=OBJECTS_PATH):
+    for name in names:
+        try:
+            os.remove(keep_pack_path(name, objects_path))
+        except FileNotFoundError:
+            pass
+
+
+def list_objects(objects_path=OBJECTS_PATH):
+    if not os.path.exists(objects_path):
+        return []
+    object_hashes = []
+    for prefix in os.listdir(objects_path):
+        if len(prefix) != 2:
+            continue
+        for rest in os.listdir(os.path.join(objects_path, prefix)):
+            if '.tmp' not in rest:
+                object_hashes.append(prefix + rest)
+    return object_hashes
+
+
+_pack_cache = {}
+
+
+def forget_packs(objects_path=OBJECTS_PATH):
+    _pack_cache.pop(os.path.abspath(objects_path), None)
+
+
+def load_packs(objects_path=OBJECTS_PATH):
+    # cached per store until the pack directory changes, which also covers long-lived processes
+    packs_path = objects_path + '/pack'
+    key = os.path.abspath(objects_path)
+    packs_mtime = os.stat(packs_path).st_mtime_ns if os.path.exists(packs_path) else None
+    if key in _pack_cache and _pack_cache[key][0] == packs_mtime:
+        return _pack_cache[key][1]
+    packs = []
+    if packs_mtime is not None:
+        # the index is renamed into place last, so a pack without one is incomplete
+        for filename in sorted(os.listdir(packs_path)):
+            if not filename.endswith('.idx'):
+                continue
+            name = filename[:-len('.idx')]
+            with open('{}/{}.idx'.format(packs_path, name), 'rb') as f:
+                idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with open('{}/{}.pack'.format(packs_path, name), 'rb') as f:
+                pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, count = PACK_INDEX_HEADER.unpack_from(idx, 0)
+            if magic != PACK_INDEX_MAGIC or version != PACK_VERSION:
+                continue
+            packs.append({'name': name, 'idx': idx, 'pack': pack, 'count': count})
+    _pack_cache[key] = (packs_mtime, packs)
+    return packs
+
+
+def pack_index_record(pack, position):
+    return PACK_INDEX_RECORD.unpack_from(pack['idx'], PACK_INDEX_HEADER.size + position * PACK_INDEX_RECORD.size)
+
+
+def find_in_pack(pack, key):
+    low, high = 0, pack['count']
+    while low < high:
+        middle = (low + high) // 2
+        record_key, offset, length = pack_index_record(pack, middle)
+        if record_key < key:
+            low = middle + 1
+        elif record_key > key:
+            high = middle
+        else:
+            return offset, length
+    return None
+
+
+def find_packed_object(object_hash, objects_path=OBJECTS_PATH):
+    key = bytes.fromhex(object_hash)
+    for pack in load_packs(objects_path):
+        found = find_in_pack(pack, key)
+        if found is not None:
+            return pack, found[0], found[1]
+    return None
+
+
+def iter_packed_object(object_hash, objects_path=OBJECTS_PATH):
+    found = find_packed_object(object_hash, objects_path)
+    if found is None:
+        raise KeyError(object_hash)
+    pack, offset, length = found
+    end = offset + length
+    entry_type = pack['pack'][offset:offset + 1]
+    if entry_type == PACK_DELTA:
+        base_hash = pack['pack'][offset + 1:offset + 21].hex()
+        delta = zlib.decompress(pack['pack'][offset + 21:end])
+        yield apply_delta(read_object(base_hash, objects_path), delta)
+        return
+    decompressor = zlib.decompressobj()
+    position = offset + len(PACK_BLOB)
+    while position < end:
+        block = pack['pack'][position:min(position + BLOCK_SIZE, end)]
+        position += len(block)
+        yield decompressor.decompress(block)
+    yield decompressor.flush()
+
+
+def iter_loose_object(object_hash, objects_path=OBJECTS_PATH):
+    with open(object_path(object_hash, objects_path), 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            yield block
+
+
+def iter_object(object_hash, objects_path=OBJECTS_PATH):
+    if os.path.exists(object_path(object_hash, objects_path)):
+        return iter_loose_object(object_hash, objects_path)
+    if find_packed_object(object_hash, objects_path) is None and fetch_missing_objects([object_hash], objects_path):
+        # left behind by a lazy fetch and now downloaded as a loose object
+        return iter_loose_object(object_hash, objects_path)
+    return iter_packed_object(object_hash, objects_path)
+
+
+def object_size(object_hash, objects_path=OBJECTS_PATH):
+    path = object_path(object_hash, objects_path)
+    if not os.path.exists(path) and find_packed_object(object_hash, objects_path) is None:
+        fetch_missing_objects([object_hash], objects_path)
+    if os.path.exists(path):
+        return os.path.getsize(path)
+    found = find_packed_object(object_hash, objects_path)
+    if found is None:
+        raise KeyError(object_hash)
+    pack, offset, length = found
+    if pack['pack'][offset:offset + 1] == PACK_DELTA:
+        # a delta starts with the size of the object it produces
+        start = offset + 21
+        header = zlib.decompressobj().decompress(pack['pack'][start:min(start + BLOCK_SIZE, offset + length)], 8)
+        return struct.unpack('>Q', header)[0]
+    # packed blobs do not record their size, so it is counted without keeping the data
+    return sum(len(block) for block in iter_packed_object(object_hash, objects_path))
+
+
+def read_object(object_hash, objects_path=OBJECTS_PATH, limit=None):
+    # with a limit, objects larger than it are not read into memory and None is returned
+    data = bytearray()
+    for block in iter_object(object_hash, objects_path):
+        data += block
+        if limit is not None and len(data) > limit:
+            return None
+    return bytes(data)
+
+
+def delta_depth(object_hash, objects_path=OBJECTS_PATH, depths=None):
+    if depths is not None and object_hash in depths:
+        return depths[object_hash]
+    depth = 0
+    found = find_packed_object(object_hash, objects_path)
+    if found is not None and not os.path.exists(object_path(object_hash, objects_path)):
+        pack, offset, _ = found
+        if pack['pack'][offset:offset + 1] == PACK_DELTA:
+            depth = 1 + delta_depth(pack['pack'][offset + 1:offset + 21].hex(), objects_path, depths)
+    if depths is not None:
+        depths[object_hash] = depth
+    return depth
+
+
+def match_length(base, base_offset, target, target_offset):
+    length = 0
+    limit = min(len(base) - base_offset, len(target) - target_offset)
+    # compare whole blocks first so long runs do not loop byte by byte
+    while length + BLOCK_SIZE <= limit and \
+            base[base_offset + length:base_offset + length + BLOCK_SIZE] == \
+            target[target_offset + length:target_offset + length + BLOCK_SIZE]:
+        length += BLOCK_SIZE
+    while length < limit and base[base_offset + length] == target[target_offset + length]:
+        length += 1
+    return length
+
+
+def make_delta(base, target, max_insert=None):
+    # returns None as soon as more than max_insert bytes of target would have to be inserted
+    blocks = {}
+    for offset in range(0, len(base) - DELTA_BLOCK_SIZE + 1, DELTA_BLOCK_SIZE):
+        blocks.setdefault(base[offset:offset + DELTA_BLOCK_SIZE], offset)
+
+    budget = len(target) if max_insert is None else max_insert
+    delta = [struct.pack('>Q', len(target))]
+    insert_start = 0
+    position = 0
+    stop = budget
+    while position + DELTA_BLOCK_SIZE <= len(target):
+        offset = blocks.get(target[position:position + DELTA_BLOCK_SIZE])
+        if offset is None:
+            # deep into unmatched data, a step coprime with the block size still meets every
+            # match of 256 bytes or more, and extending it backwards recovers its start
+            position += 1 if position - insert_start < DELTA_SKIP_AFTER else DELTA_BLOCK_SIZE - 1
+            if position > stop:
+                return None
+            continue
+        length = match_length(base, offset, target, position)
+        while position > insert_start and offset > 0 and base[offset - 1] == target[position - 1]:
+            position -= 1
+            offset -= 1
+            length += 1
+        if position > insert_start:
+            budget -= position - insert_start
+            delta.append(DELTA_INSERT + struct.pack('>I', position - insert_start) + target[insert_start:position])
+        delta.append(DELTA_COPY + struct.pack('>II', offset, length))
+        position += length
+        insert_start = position
+        stop = insert_start + budget
+    if insert_start < len(target):
+        if len(target) - insert_start > budget:
+            return None
+        delta.append(DELTA_INSERT + struct.pack('>I', len(target) - insert_start) + target[insert_start:])
+    return b''.join(delta)
+
+
+def apply_delta(base, delta):
+    size, = struct.unpack_from('>Q', delta, 0)
+    target = bytearray()
+    position = 8
+    while position < len(delta):
+        op = delta[position:position + 1]
+        if op == DELTA_COPY:
+            offset, length = struct.unpack_from('>II', delta, position + 1)
+            target += base[offset:offset + length]
+            position += 9
+        else:
+            length, = struct.unpack_from('>I', delta, position + 1)
+            target += delta[position + 5:position + 5 + length]
+            position += 5 + length
+    if len(target) != size:
+        raise ValueError('delta produced {} bytes, expected {}'.format(len(target), size))
+    return bytes(target)
+
+
+@profiled('write pack')
+def write_pack(object_sources, deltas=None, objects_path=OBJECTS_PATH):
+    # object_sources maps hash -> callable yielding the object's content in blocks,
+    # deltas maps hash -> (base hash, delta) for objects stored against a base
+    if deltas is None:
+        deltas = {}
+    packs_path = objects_path + '/pack'
+    os.makedirs(packs_path, exist_ok=True)
+    object_hashes = sorted(object_sources)
+    # named after the objects and their delta bases, so a pack rewritten with other chains gets a new name
+    # and readers never pair its index with the old pack
+    layout = ''.join(object_hash + (deltas[object_hash][0] if object_hash in deltas else '') for object_hash in object_hashes)
+    name = 'pack-' + hashlib.sha1(layout.encode()).hexdigest()
+    pack_tmp = '{}/{}.pack.tmp{}'.format(packs_path, name, os.getpid())
+    idx_tmp = '{}/{}.idx.tmp{}'.format(packs_path, name, os.getpid())
+
+    records = []
+    with open(pack_tmp, 'wb') as f:
+        f.write(PACK_MAGIC + struct.pack('>I', PACK_VERSION))
+        for object_hash in object_hashes:
+            offset = f.tell()
+            if object_hash in deltas:
+                base_hash, delta = deltas[object_hash]
+                f.write(PACK_DELTA + bytes.fromhex(base_hash) + zlib.compress(delta))
+            else:
+                f.write(PACK_BLOB)
+                compressor = zlib.compressobj()
+                for block in object_sources[object_hash]():
+                    f.write(compressor.compress(block))
+                f.write(compressor.flush())
+            records.append((bytes.fromhex(object_hash), offset, f.tell() - offset))
+        f.flush()
+        os.fsync(f.fileno())
+
+    with open(idx_tmp, 'wb') as f:
+        f.write(PACK_INDEX_HEADER.pack(PACK_INDEX_MAGIC, PACK_VERSION, len(records)))
+        for record in records:
+            f.write(PACK_INDEX_RECORD.pack(*record))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(pack_tmp, '{}/{}.pack'.format(packs_path, name))
+    os.replace(idx_tmp, '{}/{}.idx'.format(packs_path, name))
+    forget_packs(objects_path)
+    return name
+
+
+def get_delta_bases():
+    # the base of an object is the previous version of the path it first appeared at
+    order = []
+    bases = {}
+    latest = {}
+    for commit_tag in sorted(list_commit_tags()):
+        for file, entry in load_manifest(commit_tag).items():
+            if 'hash' not in entry:
+                continue
+            object_hash = entry['hash']
+            if object_hash not in bases:
+                order.append(object_hash)
+                bases[object_hash] = latest.get(file)
+            latest[file] = object_hash
+    return order, bases
+
+
+@profiled('find deltas')
+def find_deltas(object_sources, max_depth, objects_path=OBJECTS_PATH, external_bases=True):
+    deltas = {}
+    depths = {}
+    if max_depth <= 0:
+        return deltas
+    order, bases = get_delta_bases()
+    for object_hash in order:
+        base_hash = bases[object_hash]
+        if object_hash not in object_sources or base_hash is None or base_hash == object_hash:
+            continue
+        if base_hash not in object_sources and (not external_bases or not has_object(base_hash, objects_path)):
+            continue
+        base_depth = depths.get(base_hash, 0) if base_hash in object_sources \
+            else delta_depth(base_hash, objects_path, depths)
+        if base_depth >= max_depth:
+            continue
+        target = read_object(object_hash, objects_path, DELTA_MAX_SIZE)
+        base = read_object(base_hash, objects_path, DELTA_MAX_SIZE) if target is not None else None
+        # a base much smaller than the target leaves too much to insert, and one far larger costs
+        # more to index than the delta could save
+        if base is None or len(target) - len(base) >= len(target) // 2 or len(base) > 32 * len(target):
+            continue
+        delta = make_delta(base, target, len(target) // 2)
+        if delta is not None and len(delta) < len(target) // 2:
+            deltas[object_hash] = (base_hash, delta)
+            depths[object_hash] = base_depth + 1
+    return deltas
+
+
+@profiled('repack')
+def repack(all_packs=False, max_delta_depth=DEFAULT_MAX_DELTA_DEPTH, objects_path=OBJECTS_PATH, keep=None, rewrite=False):
+    # with keep, objects for which keep(hash) is false are left out of the new pack and deleted;
+    # rewrite repacks even a lone pack, so a new max_delta_depth applies to history already packed
+    loose_objects = list_objects(objects_path)
+    object_sources = {}
+    for object_hash in loose_objects:
+        object_sources[object_hash] = lambda object_hash=object_hash: iter_loose_object(object_hash, objects_path)
+
+    old_packs = load_packs(objects_path) if all_packs else []
+    for pack in old_packs:
+        for position in range(pack['count']):
+            key = pack_index_record(pack, position)[0].hex()
+            if key not in object_sources:
+                object_sources[key] = lambda key=key: iter_packed_object(key, objects_path)
+
+    dropped = []
+    if keep is not None:
+        dropped = [object_hash for object_hash in object_sources if not keep(object_hash)]
+        for object_hash in dropped:
+            del object_sources[object_hash]
+    if not dropped and (not object_sources or (not loose_objects and len(old_packs) <= (0 if rewrite else 1))):
+        return None, 0, 0
+
+    # packed objects are read back in full, so a kept delta never depends on a dropped base
+    name, deltas = None, {}
+    if object_sources:
+        deltas = find_deltas(object_sources, max_delta_depth, objects_path, external_bases=keep is None)
+        name = write_pack(object_sources, deltas, objects_path)
+    for pack in old_packs:
+        if pack['name'] != name:
+            os.remove('{}/pack/{}.idx'.format(objects_path, pack['name']))
+            os.remove('{}/pack/{}.pack'.format(objects_path, pack['name']))
+    forget_packs(objects_path)
+    for object_hash in loose_objects:
+        os.remove(object_path(object_hash, objects_path))
+    for prefix in os.listdir(objects_path):
+        if len(prefix) == 2 and not os.listdir(os.path.join(objects_path, prefix)):
+            os.rmdir(os.path.join(objects_path, prefix))
+    return name, len(object_sources), len(deltas)
+
+
+def list_commit_tags(commits_path=COMMITS_PATH):
+    # a commit directory without its manifest is a partial copy and is not a commit yet
+    if not os.path.exists(commits_path):
+        return set()
+    return set(tag for tag in os.listdir(commits_path)
+               if not tag.startswith('.') and os.path.exists('{}/{}/.vcs'.format(commits_path, tag)))
+
+
+def format_commit_tag(value, user):
+    return 'V{:05d}_{}'.format(value, user)
+
+
+def store_object_data(data, objects_path=OBJECTS_PATH):
+    object_hash = hashlib.sha1(data).hexdigest()
+    if has_object(object_hash, objects_path):
+        count('objects deduplicated')
+        return object_hash
+    count('objects written')
+    count('bytes written', len(data))
+    dst = object_path(object_hash, objects_path)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = '{}.tmp{}_{}'.format(dst, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, dst)
+    return object_hash
+
+
+def chunk_tables():
+    # a random 10-bit value per byte, split into its low byte and its top two bits
+    rng = random.Random(317)
+    values = [rng.getrandbits(10) for _ in range(256)]
+    return bytes(value & 0xFF for value in values), bytes(value >> 8 for value in values)
+
+
+CHUNK_TABLE_LOW, CHUNK_TABLE_HIGH = chunk_tables()
+
+
+def window_sums(block):
+    # the rolling sum of the table values over the CHUNK_WINDOW bytes ending at each position, for the whole
+    # block at once: every byte gets a 16-bit field in one big integer, and adding shifted copies of it
+    # sums the window in log2(CHUNK_WINDOW) steps; returns the fields little-endian
+    fields = bytearray(2 * len(block))
+    fields[0::2] = block.translate(CHUNK_TABLE_LOW)
+    fields[1::2] = block.translate(CHUNK_TABLE_HIGH)
+    sums = int.from_bytes(fields, 'little')
+    width = 16
+    while width < 16 * CHUNK_WINDOW:
+        sums += sums << width
+        width *= 2
+    return sums.to_bytes(2 * (len(block) + CHUNK_WINDOW), 'little')[:2 * len(block)]
+
+
+def find_chunk_boundary(data):
+    # a cut follows a position whose window sum has its low 8 bits zero and whose window's crc32 has its low
+    # 12 bits zero, about one position in 2^20; both depend only on the last CHUNK_WINDOW bytes, so cuts
+    # follow content and line up again after an edit
+    if len(data) <= CHUNK_MIN_SIZE:
+        return len(data)
+    end = min(len(data), CHUNK_MAX_SIZE)
+    for first in range(CHUNK_MIN_SIZE - 1, end, CHUNK_SCAN_BLOCK):
+        # positions first up to first + CHUNK_SCAN_BLOCK, with the window before the first of them
+        offset = first - CHUNK_WINDOW + 1
+        block = bytes(data[offset:min(first + CHUNK_SCAN_BLOCK, end)])
+        low_bytes = window_sums(block)[0::2]
+        position = low_bytes.find(b'\x00', CHUNK_WINDOW - 1)
+        while position != -1:
+            if zlib.crc32(block[position - CHUNK_WINDOW + 1:position + 1]) & 0xFFF == 0:
+                return offset + position + 1
+            position = low_bytes.find(b'\x00', position + 1)
+    return end
+
+
+def iter_chunks(filename):
+    buffer = bytearray()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(CHUNK_MAX_SIZE)
+            buffer += block
+            while len(buffer) >= CHUNK_MAX_SIZE or (not block and buffer):
+                cut = find_chunk_boundary(buffer)
+                yield bytes(buffer[:cut])
+                del buffer[:cut]
+            if not block:
+                return
+
+
+def store_chunked(filename, objects_path=OBJECTS_PATH):
+    sha = hashlib.sha1()
+    chunks = []
+    size = 0
+    for chunk in iter_chunks(filename):
+        sha.update(chunk)
+        size += len(chunk)
+        chunks.append([store_object_data(chunk, objects_path), len(chunk)])
+    data = json.dumps({'size': size, 'chunks': chunks}, separators=(',', ':')).encode()
+    return sha.hexdigest(), store_object_data(data, objects_path)
+
+
+def read_chunk_list(chunks_hash, objects_path=OBJECTS_PATH):
+    return json.loads(read_object(chunks_hash, objects_path).decode())
+
+
+class LRUCache:
+    # forgets the least recently used entries past max_size, so caches living in the daemon do not
+    # grow with every commit
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+
+_tree_cache = LRUCache(TREE_CACHE_SIZE)
+
+
+def read_tree(tree_hash, objects_path=OBJECTS_PATH):
+    key = (os.path.abspath(objects_path), tree_hash)
+    tree = _tree_cache.get(key)
+    count('tree cache hits' if tree is not None else 'tree cache misses')
+    if tree is None:
+        tree = json.loads(read_object(tree_hash, objects_path).decode())
+        _tree_cache[key] = tree
+    return tree
+
+
+def write_tree(entries, objects_path=OBJECTS_PATH):
+    data = json.dumps(entries, sort_keys=True, separators=(',', ':')).encode()
+    return store_object_data(data, objects_path)
+
+
+def flatten_tree(tree_hash, directory='.', objects_path=OBJECTS_PATH, manifest=None):
+    if manifest is None:
+        manifest = {}
+    for name, entry in sorted(read_tree(tree_hash, objects_path).items()):
+        path = directory + '/' + name
+        if entry['type'] == 'tree':
+            flatten_tree(entry['hash'], path, objects_path, manifest)
+        else:
+            manifest[path] = manifest_entry(entry)
+    return manifest
 
 
-def get_unchanged_deleted_files(working_files, config):
-    unchanged_files = []
-    deleted_files = []
-    if config['last_commit']['value'] == 0:
-        return unchanged_files, deleted_files
+def manifest_entry(entry):
+    manifest_entry = {
+        'value': entry['value'],
+        'subdir': COMMITS_PATH + '/' + format_commit_tag(entry['value'], entry['user']),
+        'user': entry['user'],
+        'hash': entry['hash']
+    }
+    if 'chunks' in entry:
+        manifest_entry['chunks'] = entry['chunks']
+    return manifest_entry
+
+
+@profiled('write trees')
+def write_tree_changes(tree_hash, changes, objects_path=OBJECTS_PATH):
+    # changes maps path -> blob entry, or None for a deletion; only directories
+    # containing a change are rewritten, every other subtree keeps its hash
+    files_by_dir = {}
+    subdirs_by_dir = {}
+    for path, entry in changes.items():
+        directory, name = os.path.split(path)
+        files_by_dir.setdefault(directory, {})[name] = entry
+        while directory != '.':
+            parent, child = os.path.split(directory)
+            subdirs_by_dir.setdefault(parent, set()).add(child)
+            directory = parent
+
+    def build(directory, subtree_hash):
+        entries = dict(read_tree(subtree_hash, objects_path)) if subtree_hash else {}
+        for name, entry in files_by_dir.get(directory, {}).items():
+            if entry is not None:
+                entries[name] = dict(entry, type='blob')
+            elif entries.get(name, {}).get('type') == 'blob':
+                entries.pop(name)
+        for name in subdirs_by_dir.get(directory, ()):
+            child = entries.get(name)
+            child_tree = child['hash'] if child is not None and child['type'] == 'tree' else None
+            child_hash = build(directory + '/' + name, child_tree)
+            if child_hash is not None:
+                entries[name] = {'type': 'tree', 'hash': child_hash}
+            elif child_tree is not None:
+                entries.pop(name)
+        if not entries and directory != '.':
+            return None
+        return write_tree(entries, objects_path)
+
+    return build('.', tree_hash)
+
+
+def collect_tree_objects(tree_hash, objects_path, known=None, trees=None, blobs=None):
+    # gathers trees and chunk lists (children before parents) and blobs below
+    # tree_hash, skipping subtrees for which known(hash) is true
+    if trees is None:
+        trees, blobs = [], set()
+    if known is not None and known(tree_hash):
+        return trees, blobs
+    for entry in read_tree(tree_hash, objects_path).values():
+        if entry['type'] == 'tree':
+            collect_tree_objects(entry['hash'], objects_path, known, trees, blobs)
+        elif 'chunks' in entry:
+            if (known is None or not known(entry['chunks'])) and entry['chunks'] not in trees:
+                for chunk_hash, _ in read_chunk_list(entry['chunks'], objects_path)['chunks']:
+                    if known is None or not known(chunk_hash):
+                        blobs.add(chunk_hash)
+                trees.append(entry['chunks'])
+        elif known is None or not known(entry['hash']):
+            blobs.add(entry['hash'])
+    if tree_hash not in trees:
+        trees.append(tree_hash)
+    return trees, blobs
+
+
+_commit_cache = LRUCache(COMMIT_CACHE_SIZE)
+_manifest_cache = LRUCache(MANIFEST_CACHE_SIZE)
+
+
+def read_commit(commit_tag, commits_path=COMMITS_PATH):
+    key = (os.path.abspath(commits_path), commit_tag)
+    commit = _commit_cache.get(key)
+    if commit is None:
+        commit = read_json_file('{}/{}/.vcs'.format(commits_path, commit_tag))
+        _commit_cache[key] = commit
+    return commit
+
+
+@profiled('load manifest')
+def load_manifest(commit_tag, commits_path=COMMITS_PATH):
+    # parsed once per command; manifests written before tree objects keep a flat 'commits' map
+    key = (os.path.abspath(commits_path), commit_tag)
+    manifest = _manifest_cache.get(key)
+    count('manifest cache hits' if manifest is not None else 'manifest cache misses')
+    if manifest is None:
+        commit = read_commit(commit_tag, commits_path)
+        if 'tree' in commit:
+            objects_path = os.path.dirname(commits_path) + '/objects'
+            manifest = flatten_tree(commit['tree'], objects_path=objects_path)
+        else:
+            manifest = commit['commits']
+        _manifest_cache[key] = manifest
+    return manifest
+
+
+def parse_commit_tag(commit_tag):
+    value, _, user = commit_tag[1:].partition('_')
+    return int(value), user
+
+
+def commit_parents(commit_tag, commits_path=COMMITS_PATH):
+    # only parents present here; gc and fetches of pruned histories can leave a commit without them
+    commit = read_commit(commit_tag, commits_path)
+    if 'parents' in commit:
+        return [parent for parent in commit['parents'] if os.path.exists('{}/{}/.vcs'.format(commits_path, parent))]
+    # older commits only encode their order in the tag, each following the same user's previous one
+    value, user = parse_commit_tag(commit_tag)
+    parent_tag = format_commit_tag(value - 1, user)
+    if value > 1 and os.path.exists('{}/{}/.vcs'.format(commits_path, parent_tag)):
+        return [parent_tag]
+    return []
+
+
+def commit_timestamp(commit_tag, commits_path=COMMITS_PATH):
+    commit = read_commit(commit_tag, commits_path)
+    if 'timestamp' in commit:
+        return commit['timestamp']
+    return int(os.path.getmtime('{}/{}/.vcs'.format(commits_path, commit_tag)))
+
+
+def diff_trees(tree_a, tree_b, directory='.', objects_path=OBJECTS_PATH, changed=None):
+    # only subtrees whose hashes differ are read
+    if changed is None:
+        changed = set()
+    if tree_a == tree_b:
+        return changed
+    entries_a = read_tree(tree_a, objects_path) if tree_a else {}
+    entries_b = read_tree(tree_b, objects_path) if tree_b else {}
+    for name in set(entries_a) | set(entries_b):
+        entry_a = entries_a.get(name)
+        entry_b = entries_b.get(name)
+        if entry_a is not None and entry_b is not None \
+                and entry_a['type'] == entry_b['type'] and entry_a['hash'] == entry_b['hash']:
+            continue
+        path = directory + '/' + name
+        subtree_a = entry_a['hash'] if entry_a is not None and entry_a['type'] == 'tree' else None
+        subtree_b = entry_b['hash'] if entry_b is not None and entry_b['type'] == 'tree' else None
+        if subtree_a is not None or subtree_b is not None:
+            diff_trees(subtree_a, subtree_b, path, objects_path, changed)
+        if subtree_a is None and entry_a is not None or subtree_b is None and entry_b is not None:
+            changed.add(path)
+    return changed
+
+
+def commit_changed_paths(commit_tag, commits_path=COMMITS_PATH):
+    parents = commit_parents(commit_tag, commits_path)
+    commit = read_commit(commit_tag, commits_path)
+    parent = read_commit(parents[0], commits_path) if parents else {'tree': None}
+    if 'tree' in commit and 'tree' in parent:
+        return diff_trees(parent['tree'], commit['tree'])
+    manifest = load_manifest(commit_tag, commits_path)
+    parent_manifest = load_manifest(parents[0], commits_path) if parents else {}
+    return set(file for file in set(manifest) | set(parent_manifest)
+               if manifest.get(file, {}).get('value') != parent_manifest.get(file, {}).get('value')
+               or manifest.get(file, {}).get('user') != parent_manifest.get(file, {}).get('user'))
+
+
+def read_commit_graph():
+    if not os.path.exists(COMMIT_GRAPH_PATH):
+        return {'commits': {}}
+    return read_json_file(COMMIT_GRAPH_PATH)
+
+
+@profiled('update commit graph')
+def update_commit_graph():
+    # adds any commit missing from the graph, parents before children
+    graph = read_commit_graph()
+    missing = sorted(list_commit_tags() - set(graph['commits']), reverse=True)
+    if not missing:
+        return graph
+    while missing:
+        commit_tag = missing[-1]
+        if commit_tag in graph['commits']:
+            missing.pop()
+            continue
+        parents = commit_parents(commit_tag)
+        pending = [parent for parent in parents if parent not in graph['commits']]
+        if pending:
+            missing.extend(pending)
+            continue
+        missing.pop()
+        graph['commits'][commit_tag] = {
+            'parents': parents,
+            'generation': 1 + max([graph['commits'][parent]['generation'] for parent in parents] or [0]),
+            'timestamp': commit_timestamp(commit_tag),
+            'changed': sorted(commit_changed_paths(commit_tag))
+        }
+    tmp = '{}.tmp{}'.format(COMMIT_GRAPH_PATH, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(graph, f, separators=(',', ':'))
+    os.replace(tmp, COMMIT_GRAPH_PATH)
+    return graph
+
+
+def read_pruned_tags():
+    # commits removed by gc, so a fetch does not bring them back
+    if not os.path.exists(PRUNED_PATH):
+        return set()
+    with open(PRUNED_PATH, 'r') as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def read_shallow_tags():
+    # commits fetched with --depth whose parents were left on the peer
+    if not os.path.exists(SHALLOW_PATH):
+        return set()
+    with open(SHALLOW_PATH, 'r') as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def head_tags(config):
+    # the current commit and each peer's latest fetched commit
+    heads = set()
+    if config['last_commit']['value'] > 0:
+        heads.add(format_commit_tag(config['last_commit']['value'], config['last_commit']['user']))
+    if isinstance(config.get('last_fetch'), dict):
+        heads.update(peer['commit'] for peer in config['last_fetch'].values())
+    return heads
+
+
+def shallow_tags(head_tags, depth, commits_path=COMMITS_PATH):
+    # the heads and their ancestors up to depth - 1 parents away
+    tags = set()
+    level = sorted(head_tags)
+    for _ in range(depth):
+        level = [tag for tag in dict.fromkeys(level)
+                 if tag not in tags and os.path.exists('{}/{}/.vcs'.format(commits_path, tag))]
+        tags.update(level)
+        level = [parent for tag in level for parent in commit_parents(tag, commits_path)]
+    return tags
+
+
+def update_shallow_tags(fetched_tags):
+    # returns True when a fetch brought in parents of earlier shallow commits, whose graph entries are then stale
+    previous = read_shallow_tags()
+    existing = list_commit_tags()
+    pruned = read_pruned_tags()
+    shallow = set(tag for tag in previous | set(fetched_tags) if tag in existing and any(
+        parent not in existing and parent not in pruned for parent in read_commit(tag).get('parents', [])))
+    if shallow != previous:
+        if shallow:
+            with open(SHALLOW_PATH, 'w') as f:
+                for commit_tag in sorted(shallow):
+                    f.write(commit_tag + '\n')
+        elif os.path.exists(SHALLOW_PATH):
+            os.remove(SHALLOW_PATH)
+    return bool((previous & existing) - shallow)
+
+
+def parse_date(value):
+    # an absolute date, or an age such as 12h, 30d or 2w
+    units = {'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+    if value[:-1].isdigit() and value[-1:] in units:
+        return time.time() - int(value[:-1]) * units[value[-1]]
+    for date_format in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
+        try:
+            return time.mktime(time.strptime(value, date_format))
+        except ValueError:
+            pass
+    raise ValueError('unrecognized date {}'.format(value))
+
+
+def retained_commits(graph, config, keep=None, since=None):
+    commits = graph['commits']
+    retained = set(commits)
+    if keep is not None or since is not None:
+        retained = set()
+        if keep is not None:
+            newest = sorted(commits, key=lambda tag: (commits[tag]['timestamp'], commits[tag]['generation']), reverse=True)
+            retained.update(newest[:keep])
+        if since is not None:
+            retained.update(tag for tag in commits if commits[tag]['timestamp'] >= since)
+
+    # the current commit and each peer's latest fetched commit are always kept
+    retained.update(head_tags(config))
+    existing = list_commit_tags()
+    retained &= existing
+
+    # commits from before the object store keep unhashed files in the directory they were first committed in
+    pending = list(retained)
+    while pending:
+        commit = read_commit(pending.pop())
+        if 'tree' in commit:
+            continue
+        for entry in commit['commits'].values():
+            commit_tag = os.path.basename(entry.get('subdir', '').rstrip('/'))
+            if 'hash' not in entry and commit_tag in existing and commit_tag not in retained:
+                retained.add(commit_tag)
+                pending.append(commit_tag)
+    return retained
+
+
+@profiled('mark reachable')
+def mark_reachable(commit_tags, jobs=1):
+    marked = set()
+    lock = threading.Lock()
+
+    def claim(object_hash):
+        with lock:
+            if object_hash in marked:
+                return False
+            marked.add(object_hash)
+            return True
+
+    def mark_tree(tree_hash):
+        # a subtree shared with an already marked commit is only walked once
+        if not claim(tree_hash):
+            return
+        for entry in read_tree(tree_hash).values():
+            if entry['type'] == 'tree':
+                mark_tree(entry['hash'])
+                continue
+            claim(entry['hash'])
+            if 'chunks' in entry and claim(entry['chunks']):
+                for chunk_hash, _ in read_chunk_list(entry['chunks'])['chunks']:
+                    claim(chunk_hash)
+
+    def mark_commit(commit_tag):
+        commit = read_commit(commit_tag)
+        if 'tree' in commit:
+            mark_tree(commit['tree'])
+        else:
+            for entry in commit['commits'].values():
+                if 'hash' in entry:
+                    claim(entry['hash'])
 
-    LAST_COMMIT_SUBDIR = COMMITS_PATH + '/V{:05d}_{}'.format(config['last_commit']['value'],
-                                                                 config['last_commit']['user'])
+    parallel_map(mark_commit, sorted(commit_tags), jobs)
+    count('objects marked', len(marked))
+    return marked
 
-    vcs = read_json_file('{}/.vcs'.format(LAST_COMMIT_SUBDIR))
 
-    for file in vcs['commits']:
-        if file in working_files:
-            if filecmp.cmp(file, vcs['commits'][file]['subdir'] + file[1:]):
-                unchanged_files.append(file)
-        else:
-            deleted_files.append(file)
-    return unchanged_files, deleted_files
+def directory_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
 
 
-def create_commit_subdir(working_files, unchanged_files, deleted_files, to_ignore, config):
-    new_commit_value = config['last_commit']['value'] + 1
-    NEW_COMMIT_SUBDIR = COMMITS_PATH + '/V{:05d}_{}'.format(new_commit_value, config['last_commit']['user'])
+def list_all_objects(objects_path=OBJECTS_PATH):
+    object_hashes = set(list_objects(objects_path))
+    for pack in load_packs(objects_path):
+        for position in range(pack['count']):
+            object_hashes.add(pack_index_record(pack, position)[0].hex())
+    return object_hashes
 
-    def custom_ignore(path, filenames):
-        ignore = []
-        for filename in filenames:
-            if os.path.join(path, filename) in unchanged_files:
-                ignore.append(filename)
-            elif filename in to_ignore:
-                ignore.append(filename)
-        return ignore
 
-    shutil.copytree(src=WORKING_DIR,
-                    dst=NEW_COMMIT_SUBDIR,
-                    ignore=custom_ignore)
+@profiled('gc')
+def gc(keep=None, since=None, expire=GC_GRACE_SECONDS, jobs=1, dry_run=False):
+    config = read_config_file()
+    graph = update_commit_graph()
+    retained = retained_commits(graph, config, keep, since)
+    existing = list_commit_tags()
+    pruned = sorted(existing - retained)
+    cutoff = time.time() - expire
+
+    # anything younger than the cutoff may belong to a commit or fetch that is still running
+    partial = [name for name in os.listdir(COMMITS_PATH)
+               if name not in existing and os.lstat(os.path.join(COMMITS_PATH, name)).st_mtime < cutoff]
+    marked = mark_reachable(retained, jobs)
+    loose = list_objects()
+    young = set(object_hash for object_hash in loose if os.lstat(object_path(object_hash)).st_mtime >= cutoff)
+    for pack in load_packs():
+        keep_path = keep_pack_path(pack['name'])
+        if os.path.exists(keep_path) and os.lstat(keep_path).st_mtime >= cutoff:
+            young.update(pack_index_record(pack, position)[0].hex() for position in range(pack['count']))
+    unreachable = [object_hash for object_hash in list_all_objects()
+                   if object_hash not in marked and object_hash not in young]
+    result = {'commits': pruned, 'partial': partial, 'objects': len(unreachable), 'kept_commits': len(retained), 'freed': 0}
+    if dry_run:
+        return result
+
+    size_before = directory_size(VCS_PATH)
+    if pruned:
+        with open(PRUNED_PATH, 'a') as f:
+            for commit_tag in pruned:
+                f.write(commit_tag + '\n')
+    for name in pruned + partial:
+        path = os.path.join(COMMITS_PATH, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    for commit_tag in pruned:
+        _commit_cache.pop((os.path.abspath(COMMITS_PATH), commit_tag), None)
+        _manifest_cache.pop((os.path.abspath(COMMITS_PATH), commit_tag), None)
+
+    if pruned:
+        pruned_set = set(pruned)
+        for commit_tag in pruned:
+            graph['commits'].pop(commit_tag, None)
+        for node in graph['commits'].values():
+            node['parents'] = [parent for parent in node['parents'] if parent not in pruned_set]
+        tmp = '{}.tmp{}'.format(COMMIT_GRAPH_PATH, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(graph, f, separators=(',', ':'))
+        os.replace(tmp, COMMIT_GRAPH_PATH)
+
+    for prefix in os.listdir(OBJECTS_PATH) if os.path.exists(OBJECTS_PATH) else []:
+        if len(prefix) != 2:
+            continue
+        for rest in os.listdir(os.path.join(OBJECTS_PATH, prefix)):
+            path = os.path.join(OBJECTS_PATH, prefix, rest)
+            if '.tmp' in rest and os.lstat(path).st_mtime < cutoff:
+                os.remove(path)
+    # .keep files left behind by a fetch that died
+    for filename in os.listdir(PACKS_PATH) if os.path.exists(PACKS_PATH) else []:
+        path = os.path.join(PACKS_PATH, filename)
+        if filename.endswith('.keep') and os.lstat(path).st_mtime < cutoff:
+            os.remove(path)
+
+    # the surviving objects are consolidated into one pack, which drops unreachable packed objects too
+    unreachable_set = set(unreachable)
+    repack(all_packs=True, max_delta_depth=config.get('max_delta_depth', DEFAULT_MAX_DELTA_DEPTH),
+           keep=lambda object_hash: object_hash not in unreachable_set)
+    result['freed'] = size_before - directory_size(VCS_PATH)
+    return result
+
+
+def verify_object(object_hash, objects_path=OBJECTS_PATH, keep=False):
+    # the size of an object, or with keep its content; None when it does not hash to its name.
+    # unlike iter_object, a missing object is never fetched on demand
+    sha = hashlib.sha1()
+    size = 0
+    data = bytearray()
+    try:
+        if os.path.exists(object_path(object_hash, objects_path)):
+            blocks = iter_loose_object(object_hash, objects_path)
+        else:
+            blocks = iter_packed_object(object_hash, objects_path)
+        for block in blocks:
+            sha.update(block)
+            size += len(block)
+            if keep:
+                data += block
+    except (OSError, KeyError, ValueError, zlib.error, struct.error):
+        return None
+    if sha.hexdigest() != object_hash:
+        return None
+    return bytes(data) if keep else size
+
+
+def object_location(object_hash, objects_path=OBJECTS_PATH):
+    # loose objects in path order, then packed objects in pack order, so reads stay mostly sequential
+    if os.path.exists(object_path(object_hash, objects_path)):
+        return (0, object_hash, 0)
+    found = find_packed_object(object_hash, objects_path)
+    return (1, found[0]['name'], found[1])
+
+
+@profiled('fsck')
+def fsck(commit_tags, jobs=1, received=None, progress=False):
+    # with received, only those objects are checked: anything else was complete before the fetch
+    # that brought them, as trees are always stored after their contents
+    problems = []
+    lazy = bool(read_config_file().get('promisors'))
+    referenced = {}
+    seen = set()
+    files = set()
+
+    def check(object_hash):
+        return received is None or object_hash in received
+
+    def read_listing(object_hash, where, kind):
+        if not has_object(object_hash):
+            problems.append('missing {} {} ({})'.format(kind, object_hash, where))
+            return None
+        data = verify_object(object_hash, keep=True)
+        if data is not None:
+            try:
+                return json.loads(data.decode())
+            except ValueError:
+                pass
+        problems.append('corrupt {} {} ({})'.format(kind, object_hash, where))
+        return None
+
+    def walk_chunks(chunks_hash, where):
+        if chunks_hash in seen or not check(chunks_hash):
+            return
+        seen.add(chunks_hash)
+        chunk_list = read_listing(chunks_hash, where, 'chunk list')
+        for chunk_hash, _ in chunk_list['chunks'] if chunk_list is not None else []:
+            referenced.setdefault(chunk_hash, where)
+
+    def walk_tree(tree_hash, where):
+        if tree_hash in seen or not check(tree_hash):
+            return
+        seen.add(tree_hash)
+        entries = read_listing(tree_hash, where, 'tree')
+        for name, entry in sorted(entries.items()) if entries is not None else []:
+            path = where + '/' + name
+            if entry['type'] == 'tree':
+                walk_tree(entry['hash'], path)
+            elif 'chunks' in entry:
+                # chunked files are checked chunk by chunk; together they hash to the entry's hash
+                walk_chunks(entry['chunks'], path)
+            else:
+                referenced.setdefault(entry['hash'], path)
 
-    if config['last_commit']['value'] == 0:
-        vcs = {'commits': {}, 'latest_fetch': {}}
+    for commit_tag in sorted(commit_tags):
+        try:
+            commit = read_json_file('{}/{}/.vcs'.format(COMMITS_PATH, commit_tag))
+        except (OSError, ValueError):
+            problems.append('unreadable commit {}'.format(commit_tag))
+            continue
+        if 'tree' in commit:
+            walk_tree(commit['tree'], commit_tag + ':.')
+            continue
+        # commits from before the object store point at copies under a commit subdir
+        for file, entry in sorted(commit['commits'].items()):
+            if 'hash' in entry:
+                referenced.setdefault(entry['hash'], '{}:{}'.format(commit_tag, file))
+                continue
+            path = os.path.normpath(os.path.join(entry['subdir'], file))
+            if path not in files:
+                files.add(path)
+                if not os.path.isfile(path):
+                    problems.append('missing file {} ({}:{})'.format(path, commit_tag, file))
+
+    wanted = [object_hash for object_hash in referenced if check(object_hash)]
+    present = [object_hash for object_hash in wanted if has_object(object_hash)]
+    # a lazy fetch leaves file contents with its peers on purpose
+    promised = len(wanted) - len(present) if lazy else 0
+    if not lazy:
+        present_set = set(present)
+        problems.extend('missing object {} ({})'.format(object_hash, referenced[object_hash])
+                        for object_hash in wanted if object_hash not in present_set)
+    present.sort(key=object_location)
+
+    state = {'objects': 0, 'bytes': 0, 'shown': 0.0}
+    lock = threading.Lock()
+
+    def verify(object_hash):
+        size = verify_object(object_hash)
+        with lock:
+            state['objects'] += 1
+            state['bytes'] += size or 0
+            now = time.time()
+            if progress and (now - state['shown'] >= 0.5 or state['objects'] == len(present)):
+                state['shown'] = now
+                sys.stderr.write('\rchecking objects: {}/{} ({}%), {:.1f} MB'.format(
+                    state['objects'], len(present), 100 * state['objects'] // len(present), state['bytes'] / 1e6))
+                sys.stderr.flush()
+        return size
+
+    corrupt = [object_hash for object_hash, size in zip(present, parallel_map(verify, present, jobs)) if size is None]
+    if progress and present:
+        sys.stderr.write('\n')
+    problems.extend('corrupt object {} ({})'.format(object_hash, referenced[object_hash]) for object_hash in corrupt)
+    count('objects verified', len(present))
+    count('bytes verified', state['bytes'])
+    return {'problems': problems, 'commits': len(commit_tags), 'objects': len(present) + len(seen),
+            'bytes': state['bytes'], 'promised': promised, 'corrupt': corrupt}
+
+
+def checkout_file(entry, file, link=False):
+    # never write through an existing file, it may be a hardlink to an object
+    if os.path.lexists(file):
+        os.remove(file)
+    # commits made before the object store kept full copies under their subdir
+    if 'chunks' in entry:
+        with open(file, 'wb') as f:
+            for chunk_hash, _ in read_chunk_list(entry['chunks'])['chunks']:
+                for block in iter_object(chunk_hash):
+                    f.write(block)
+    elif 'hash' in entry:
+        copy_object(entry['hash'], file, link=link)
     else:
-        last_vcs_filepath = COMMITS_PATH + '/V{:05d}_{}/.vcs'.format(config['last_commit']['value'],
-                                                                         config['last_commit']['user'])
-        vcs = read_json_file(last_vcs_filepath)
-        for deleted_file in deleted_files:
-            vcs['commits'].pop(deleted_file)
-    for file_path in [fp for fp in working_files if fp not in unchanged_files]:
-        vcs['commits'][file_path] = {
-            'value': new_commit_value,
-            'subdir': NEW_COMMIT_SUBDIR,
-            'user': config['user']
-        }
-    write_json_file(NEW_COMMIT_SUBDIR + '/.vcs', vcs)
+        shutil.copy(os.path.join(entry['subdir'], file), file)
+
 
+_index_cache = {}
 
-def clear_directory(target_dir):
-    for file in os.listdir(target_dir):
-        if file == '.':
+
+def copy_index(index):
+    # callers add and remove entries in place, so the cache keeps its own copy of what is on disk
+    return dict(index, files=dict(index['files']))
+
+
+@profiled('read index')
+def read_index():
+    if not os.path.exists(INDEX_PATH):
+        index = {'files': {}, 'mtime': 0, 'dirty': False}
+    else:
+        # a long-lived process reuses the parsed index while the file is unchanged
+        stat = os.stat(INDEX_PATH)
+        key = os.path.abspath(INDEX_PATH)
+        cached = _index_cache.get(key)
+        if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size, stat.st_ino):
+            index = copy_index(cached[1])
+        else:
+            with open(INDEX_PATH, 'r') as f:
+                index = json.load(f)
+            # entries modified in the same tick the index was written cannot be trusted
+            index['mtime'] = stat.st_mtime_ns
+            index['dirty'] = False
+            _index_cache[key] = ((stat.st_mtime_ns, stat.st_size, stat.st_ino), copy_index(index))
+    # kept apart from the index so a clean status only rewrites this small file
+    index['monitor'] = read_json_file(MONITOR_STATE_PATH) if os.path.exists(MONITOR_STATE_PATH) else None
+    index['monitor_dirty'] = False
+    return index
+
+
+@profiled('write index')
+def write_index(index, working_files=None):
+    if working_files is not None:
+        working_set = set(working_files)
+        for file in [fp for fp in index['files'] if fp not in working_set]:
+            index['files'].pop(file)
+            index['dirty'] = True
+        if index.get('monitor') is not None:
+            # with the tracked files above this is the whole working tree the monitor token refers to
+            other = sorted(file for file in working_set if file not in index['files'])
+            if other != index['monitor'].get('other'):
+                index['monitor']['other'] = other
+                index['monitor_dirty'] = True
+    if index['dirty']:
+        tmp = '{}.tmp{}'.format(INDEX_PATH, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'files': index['files']}, f)
+        os.replace(tmp, INDEX_PATH)
+        index['dirty'] = False
+        stat = os.stat(INDEX_PATH)
+        index['mtime'] = stat.st_mtime_ns
+        _index_cache[os.path.abspath(INDEX_PATH)] = ((stat.st_mtime_ns, stat.st_size, stat.st_ino), copy_index(index))
+    # written after the index, so a crash in between leaves an older token that reports more, never less
+    if index.get('monitor_dirty'):
+        if index['monitor'] is None:
+            if os.path.exists(MONITOR_STATE_PATH):
+                os.remove(MONITOR_STATE_PATH)
+        else:
+            tmp = '{}.tmp{}'.format(MONITOR_STATE_PATH, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(index['monitor'], f)
+            os.replace(tmp, MONITOR_STATE_PATH)
+        index['monitor_dirty'] = False
+
+
+def update_index_entry(index, file, object_hash, stat=None):
+    if stat is None:
+        stat = os.stat(file)
+    index['files'][file] = {
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'ino': stat.st_ino,
+        'hash': object_hash
+    }
+    index['dirty'] = True
+
+
+def indexed_hash(file, index, trusted=False, entry=None):
+    indexed = index['files'].get(file)
+    if trusted and indexed is not None and indexed['mtime'] < index['mtime']:
+        # the monitor reported no change since the entry was stored, so skip the stat
+        count('index hits')
+        return indexed['hash']
+    # a DirEntry from the scan already holds the stat
+    stat = entry.stat() if entry is not None else os.stat(file)
+    if indexed is not None \
+            and indexed['mtime'] == stat.st_mtime_ns \
+            and indexed['size'] == stat.st_size \
+            and indexed['ino'] == stat.st_ino \
+            and indexed['mtime'] < index['mtime']:
+        count('index hits')
+        return indexed['hash']
+    count('index misses')
+    object_hash = hash_file(file)
+    update_index_entry(index, file, object_hash, stat)
+    return object_hash
+
+
+def parallel_map(func, items, jobs=1):
+    # hashing and file copies release the GIL, so threads overlap both CPU and I/O
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, items))
+
+
+def compile_patterns(patterns):
+    # gitignore-style globs: a pattern containing a slash is anchored at the repository root, any
+    # other matches a name at any depth, a trailing slash only matches directories, a leading ! negates
+    # and the last matching pattern wins; a pattern matching a directory matches everything below it
+    rules = []
+    for pattern in patterns:
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        directory_only = pattern.endswith('/')
+        anchored = '/' in pattern.rstrip('/')
+        pattern = pattern.strip('/')
+        if pattern:
+            rules.append((fnmatch.translate(pattern), negate, directory_only, anchored))
+
+    negations = any(negate for _, negate, _, _ in rules)
+    if not negations:
+        # without negations order does not matter, so each kind of pattern is joined into one regex
+        grouped = {}
+        for regex, _, directory_only, anchored in rules:
+            grouped.setdefault((directory_only, anchored), []).append(regex)
+        kinds = [(re.compile('|'.join(regexes)).match, False, directory_only, anchored)
+                 for (directory_only, anchored), regexes in grouped.items()]
+    else:
+        kinds = [(re.compile(regex).match, negate, directory_only, anchored) for regex, negate, directory_only, anchored in rules]
+
+    def matches(path, is_dir=False, ancestors=True):
+        # a scanner that never descends into matched directories only needs to check the last name
+        relative = path[2:] if path.startswith('./') else path
+        if not ancestors and not negations:
+            name = relative.rpartition('/')[2]
+            return any(match(relative if anchored else name)
+                       for match, _, directory_only, anchored in kinds if is_dir or not directory_only)
+        parts = relative.split('/')
+        last = len(parts) - 1
+        result = False
+        for match, negate, directory_only, anchored in kinds:
+            for depth in range(0 if ancestors else last, last + 1):
+                if directory_only and depth == last and not is_dir:
+                    continue
+                if match('/'.join(parts[:depth + 1]) if anchored else parts[depth]):
+                    if not negations:
+                        return True
+                    result = not negate
+                    break
+        return result
+    return matches
+
+
+_pattern_cache = {}
+
+
+def read_pattern_file(filename):
+    # compiled once per process and recompiled only when the file changes
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    key = os.path.abspath(filename)
+    cached = _pattern_cache.get(key)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    with open(filename, 'r') as f:
+        lines = [line.strip() for line in f]
+    matches = compile_patterns([line for line in lines if line and not line.startswith('#')])
+    _pattern_cache[key] = ((stat.st_mtime_ns, stat.st_size), matches)
+    return matches
+
+
+def read_ignore_file():
+    # None when nothing besides .vcs is ignored
+    return read_pattern_file(IGNORE_PATH)
+
+
+def read_sparse_checkout():
+    # None when every path is checked out
+    return read_pattern_file(SPARSE_CHECKOUT_PATH)
+
+
+@profiled('scan files')
+def scan_files(starting_directory, to_ignore):
+    # returns path -> os.DirEntry; scandir reports each entry's type without a stat, and the entry
+    # caches the stat it does make, so the index check after the scan can reuse it
+    ignore_names = set(to_ignore)
+    ignored = read_ignore_file()
+    entries = {}
+    directories = [starting_directory]
+    while directories:
+        try:
+            iterator = os.scandir(directories.pop())
+        except OSError:
             continue
-        elif file == '..':
+        with iterator:
+            for entry in iterator:
+                if entry.name in ignore_names:
+                    continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # ignored subtrees are pruned here, before anything below them is listed
+                    if ignored is None or not ignored(entry.path, True, False):
+                        directories.append(entry.path)
+                elif entry.is_symlink() and entry.is_dir():
+                    # like os.walk, links to directories are neither followed nor files
+                    continue
+                elif ignored is None or not ignored(entry.path, False, False):
+                    entries[entry.path] = entry
+    count('files scanned', len(entries))
+    return entries
+
+
+def get_file_paths(starting_directory, to_ignore):
+    return list(scan_files(starting_directory, to_ignore))
+
+
+def is_ignored(path, to_ignore):
+    # the same decision scan_files makes, for a single path reported by the monitor
+    if any(name in to_ignore for name in path.split('/')):
+        return True
+    ignored = read_ignore_file()
+    return ignored is not None and ignored(path, os.path.isdir(path))
+
+
+@profiled('scan working tree')
+def scan_working_files(index, to_ignore):
+    # returns the working files, the paths changed since the last scan (None after a full scan) and
+    # the scanned DirEntry objects whose cached stat the index check can reuse
+    monitor = index.get('monitor')
+    reply = None
+    if to_ignore == ['.vcs'] and os.path.exists(MONITOR_SOCKET_PATH):
+        try:
+            reply = send_request(MONITOR_SOCKET_PATH, {'cmd': 'changes', 'since': monitor['token'] if monitor else None})
+        except (OSError, ValueError):
+            reply = None
+
+    if (reply is None or reply.get('full') or monitor is None or 'other' not in monitor
+            or IGNORE_PATH in reply['paths']):
+        if reply is None:
+            if monitor is not None:
+                index['monitor'] = None
+                index['monitor_dirty'] = True
+        else:
+            index['monitor'] = {'token': reply['token']}
+            index['monitor_dirty'] = True
+        entries = scan_files('.', to_ignore)
+        return list(entries), None, entries
+
+    known = set(index['files'])
+    known.update(monitor['other'])
+    changed = set()
+    prefixes = []
+    entries = {}
+    for path in reply['paths']:
+        known.discard(path)
+        changed.add(path)
+        if is_ignored(path, to_ignore):
             continue
-        elif file == '.vcs':
+        if os.path.isfile(path):
+            known.add(path)
+        else:
+            prefixes.append(path + '/')
+    if prefixes:
+        # a directory was created, moved or removed, so reconcile everything below it
+        prefixes = tuple(prefixes)
+        below = set(file for file in known if file.startswith(prefixes))
+        known.difference_update(below)
+        changed.update(below)
+        for prefix in prefixes:
+            if os.path.isdir(prefix):
+                entries.update(scan_files(prefix[:-1], to_ignore))
+        known.update(entries)
+        changed.update(entries)
+    count('monitor changes', len(changed))
+    if reply['token'] != monitor['token']:
+        # files that differed from the last commit at the old token may differ still
+        pending = monitor.get('pending')
+        if pending is not None:
+            pending['files'] = sorted(changed.union(pending['files']))
+        monitor['token'] = reply['token']
+        index['monitor_dirty'] = True
+    return sorted(known), changed, entries
+
+
+@profiled('compare with last commit')
+def get_unchanged_deleted_files(working_files, config, index, jobs=1, changed=None, entries=None):
+    unchanged_files = []
+    deleted_files = []
+    file_hashes = {}
+    if config['last_commit']['value'] == 0:
+        return unchanged_files, deleted_files, file_hashes
+
+    commit_tag = format_commit_tag(config['last_commit']['value'], config['last_commit']['user'])
+    working_set = set(working_files)
+    monitor = index.get('monitor')
+    pending = monitor.get('pending') if monitor is not None and changed is not None else None
+    if pending is not None and pending['head'] == commit_tag:
+        # everything the monitor has not reported since the last comparison still matches the last commit,
+        # so only the files that differed then and the reported paths are looked up in its tree
+        candidates = set(pending['files']).union(pending['added'])
+        manifest = load_manifest_paths(commit_tag, sorted(candidates)) if candidates else {}
+        tracked_files = [file for file in sorted(manifest) if file in working_set]
+    else:
+        candidates = None
+        manifest = load_manifest(commit_tag)
+        tracked_files = [file for file in manifest if file in working_set]
+
+    def is_unchanged(file):
+        entry = manifest[file]
+        if 'hash' in entry:
+            file_hashes[file] = indexed_hash(file, index, changed is not None and file not in changed,
+                                             entries.get(file) if entries else None)
+            return file_hashes[file] == entry['hash']
+        return filecmp.cmp(file, os.path.join(entry['subdir'], file))
+
+    if candidates is not None:
+        checked_files = tracked_files
+        unchanged_files = [file for file in working_files if file not in candidates]
+    elif changed is not None:
+        # only the files the monitor reported need a stat, so the rest skip the thread pool
+        checked_files = [file for file in tracked_files if file in changed]
+        unchanged_files = [file for file in tracked_files if file not in changed and is_unchanged(file)]
+    else:
+        checked_files = tracked_files
+        unchanged_files = []
+    unchanged_flags = parallel_map(is_unchanged, checked_files, jobs)
+    unchanged_files += [file for file, unchanged in zip(checked_files, unchanged_flags) if unchanged]
+    # paths left out by sparse checkout are absent on purpose, and commits carry them forward
+    sparse = read_sparse_checkout()
+    # tracked files matching .vcontrolignore are left out of the scan but are not deletions either
+    ignored = read_ignore_file()
+    deleted_files = [file for file in manifest if file not in working_set and (sparse is None or sparse(file))
+                     and (ignored is None or not ignored(file))]
+    if monitor is not None:
+        # remembered with the monitor token, so the next comparison only looks at these and the reported paths
+        differing = [file for file, unchanged in zip(checked_files, unchanged_flags) if not unchanged]
+        if candidates is None and changed is not None:
+            unchanged_set = set(unchanged_files)
+            differing = [file for file in tracked_files if file not in unchanged_set]
+        added = [file for file in (working_files if candidates is None else candidates)
+                 if file in working_set and file not in manifest]
+        pending = {'head': commit_tag, 'files': sorted(differing + deleted_files), 'added': sorted(added)}
+        if pending != monitor.get('pending'):
+            monitor['pending'] = pending
+            index['monitor_dirty'] = True
+    return unchanged_files, deleted_files, file_hashes
+
+
+@profiled('store changes')
+def store_changes(working_files, unchanged_files, deleted_files, file_hashes, config, index, jobs=1, entries=None):
+    # objects are content addressed, so this runs without the repository lock
+    new_commit_value = config['last_commit']['value'] + 1
+    unchanged_set = set(unchanged_files)
+    changed_files = [fp for fp in working_files if fp not in unchanged_set]
+    chunk_threshold = config.get('chunk_threshold', DEFAULT_CHUNK_THRESHOLD)
+
+    def store_changed(file_path):
+        # large files are split into content-defined chunks stored as separate objects
+        entry = entries.get(file_path) if entries else None
+        size = entry.stat().st_size if entry is not None else os.path.getsize(file_path)
+        if size >= chunk_threshold:
+            return store_chunked(file_path)
+        return store_object(file_path, file_hashes.get(file_path) or indexed_hash(file_path, index, entry=entry)), None
+
+    changes = {}
+    for file_path, (object_hash, chunks_hash) in zip(changed_files, parallel_map(store_changed, changed_files, jobs)):
+        changes[file_path] = {
+            'value': new_commit_value,
+            'user': config['user'],
+            'hash': object_hash
+        }
+        if chunks_hash is not None:
+            changes[file_path]['chunks'] = chunks_hash
+    for deleted_file in deleted_files:
+        changes[deleted_file] = None
+    return changes
+
+
+def missing_change_objects(changes):
+    # a gc that ran after the objects were stored may have dropped them as unreachable
+    missing = []
+    for entry in changes.values():
+        if entry is None:
             continue
+        if 'chunks' not in entry:
+            if not has_object(entry['hash']):
+                missing.append(entry['hash'])
+        elif not has_object(entry['chunks']):
+            missing.append(entry['chunks'])
         else:
-            if os.path.isdir(file):
-                shutil.rmtree(file)
-            else:
-                os.remove(file)
+            missing.extend(chunk_hash for chunk_hash, _ in read_chunk_list(entry['chunks'])['chunks']
+                           if not has_object(chunk_hash))
+    return missing
+
+
+@profiled('write commit')
+def create_commit_subdir(changes, config):
+    # called with the repository lock held
+    new_commit_tag = format_commit_tag(config['last_commit']['value'] + 1, config['user'])
+    NEW_COMMIT_SUBDIR = COMMITS_PATH + '/' + new_commit_tag
+
+    last_tree = None
+    if config['last_commit']['value'] != 0:
+        last_commit = read_commit(format_commit_tag(config['last_commit']['value'], config['last_commit']['user']))
+        if 'tree' in last_commit:
+            last_tree = last_commit['tree']
+        else:
+            # the first commit on top of a flat manifest moves its remaining files into the object store
+            changes = dict(changes)
+            for file, entry in last_commit['commits'].items():
+                if file not in changes:
+                    changes[file] = {
+                        'value': entry['value'],
+                        'user': entry['user'],
+                        'hash': entry.get('hash') or store_object(os.path.join(entry['subdir'], file))
+                    }
+
+    vcs = {
+        'tree': write_tree_changes(last_tree, changes),
+        'parents': [],
+        'timestamp': int(time.time()),
+        'latest_fetch': {}
+    }
+    if config['last_commit']['value'] != 0:
+        vcs['parents'] = [format_commit_tag(config['last_commit']['value'], config['last_commit']['user'])]
+    if isinstance(config['last_fetch'], dict):
+        vcs['latest_fetch'] = config['last_fetch']
+
+    # built under a hidden name and renamed into place, so readers never see a partial commit
+    tmp = '{}/.{}.tmp{}'.format(COMMITS_PATH, new_commit_tag, os.getpid())
+    os.makedirs(tmp)
+    write_json_file(tmp + '/.vcs', vcs)
+    if not publish_directory(tmp, NEW_COMMIT_SUBDIR):
+        print('Commit {} already exists in this repository. Commit canceled.'.format(new_commit_tag))
+        sys.exit(1)
+    return new_commit_tag
 
 
-def revert(commit_tag, target_working_dir, target_commit_path):
+def remove_empty_directories(target_dir, file_paths):
+    directories = set()
+    for file in file_paths:
+        directory = os.path.dirname(file)
+        while directory not in ('', '.', target_dir):
+            directories.add(directory)
+            directory = os.path.dirname(directory)
+    # deepest first, so parents are emptied before they are checked
+    for directory in sorted(directories, key=len, reverse=True):
+        if os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+
+
+@profiled('revert')
+def revert(commit_tag, target_working_dir, target_commit_path, paths=None):
     REVERT_PATH = target_commit_path + "/{}".format(commit_tag)
     if not os.path.exists(REVERT_PATH):
         print("Commit tag does not exist. Revert canceled.")
         sys.exit(1)
+    check_paths(paths, 'Revert')
 
     print('revert:')
-    clear_directory(target_working_dir)
-    
-    VCS_FILE_PATH = "{}/.vcs".format(REVERT_PATH)
-    vcs = read_json_file(VCS_FILE_PATH)
 
-    file_paths = list(vcs['commits'])
-    for file in file_paths:
-        print('  {}->{} revert: {} | {}'.format('\033[93m', '\033[0m', file, os.path.basename(vcs['commits'][file]['subdir'])))
-        src_path = os.path.join(vcs['commits'][file]['subdir'], file)
+    sparse = read_sparse_checkout()
+    ignored = read_ignore_file()
+    link = read_config_file().get('storage_mode', 'copy') == 'hardlink'
+    index = read_index()
+    if paths:
+        # only the named paths are read from the commit and looked at on disk
+        manifest = load_manifest_paths(commit_tag, paths, target_commit_path)
+        working_files = []
+        for path in sorted(normalize_paths(paths)):
+            if os.path.isdir(path):
+                working_files.extend(get_file_paths(path, ['.vcs']))
+            elif os.path.isfile(path) and (ignored is None or not ignored(path)):
+                working_files.append(path)
+    else:
+        manifest = load_manifest(commit_tag, target_commit_path)
+        working_files = get_file_paths(target_working_dir, ['.vcs'])
+    if sparse is not None:
+        # paths outside the sparse checkout are never written, and removed if they are on disk
+        manifest = dict((file, entry) for file, entry in manifest.items() if sparse(file))
+    if ignored is not None:
+        # ignored files are left alone even where the commit tracks them
+        manifest = dict((file, entry) for file, entry in manifest.items() if not ignored(file))
+    working_set = set(working_files)
+    removed_files = [file for file in working_files if file not in manifest and file != IGNORE_PATH]
+
+    def is_current(file):
+        entry = manifest[file]
+        if file not in working_set:
+            return False
+        if 'hash' in entry:
+            return indexed_hash(file, index) == entry['hash']
+        return filecmp.cmp(file, os.path.join(entry['subdir'], file))
+
+    file_paths = list(manifest)
+    current_flags = parallel_map(is_current, file_paths, DEFAULT_JOBS)
+    changed_files = [file for file, current in zip(file_paths, current_flags) if not current]
+
+    # every object is checked, and after a lazy fetch downloaded, before the working directory is touched
+    missing = prefetch_entries(manifest[file] for file in changed_files)
+    if missing:
+        print("{} object(s) are missing, see vcontrol fsck. Revert canceled.".format(len(missing)))
+        sys.exit(1)
+
+    for file in removed_files:
+        print('  {}-{} remove: {}'.format('\033[91m', '\033[0m', file))
+        os.remove(file)
+        if index['files'].pop(file, None) is not None:
+            index['dirty'] = True
+    remove_empty_directories(target_working_dir, removed_files)
+
+    for file in changed_files:
+        print('  {}->{} revert: {} | {}'.format('\033[93m', '\033[0m', file, os.path.basename(manifest[file]['subdir'])))
         os.makedirs(os.path.dirname(file), exist_ok=True)
-        shutil.copy(src_path, file)
+        checkout_file(manifest[file], file, link)
+        if 'hash' in manifest[file]:
+            update_index_entry(index, file, manifest[file]['hash'])
+    write_index(index, None if paths else file_paths)
+
+    if not removed_files and not changed_files:
+        if paths:
+            print('  {} already match {}.'.format(', '.join(paths), commit_tag))
+        else:
+            print('  Working directory already matches {}.'.format(commit_tag))
+
+
+def find_tree_entry(tree_hash, path, objects_path=OBJECTS_PATH):
+    # looks a single path up without flattening the rest of the tree
+    entry = {'type': 'tree', 'hash': tree_hash}
+    if path == '.':
+        return entry
+    for name in path[2:].split('/'):
+        if entry['type'] != 'tree':
+            return None
+        entry = read_tree(entry['hash'], objects_path).get(name)
+        if entry is None:
+            return None
+    return entry
+
+
+def tree_entry(tree_hash, path, objects_path=OBJECTS_PATH):
+    entry = find_tree_entry(tree_hash, path, objects_path)
+    return entry if entry is not None and entry['type'] != 'tree' else None
+
+
+def load_manifest_paths(commit_tag, paths, commits_path=COMMITS_PATH):
+    # the manifest restricted to paths, reading only the subtrees below them
+    commit = read_commit(commit_tag, commits_path)
+    prefixes = normalize_paths(paths)
+    if 'tree' not in commit or '.' in prefixes:
+        matches = path_filter(paths)
+        return dict((file, entry) for file, entry in load_manifest(commit_tag, commits_path).items() if matches(file))
+    objects_path = os.path.dirname(commits_path) + '/objects'
+    manifest = {}
+    for prefix in sorted(prefixes):
+        entry = find_tree_entry(commit['tree'], prefix, objects_path)
+        if entry is None:
+            continue
+        if entry['type'] == 'tree':
+            flatten_tree(entry['hash'], prefix, objects_path, manifest)
+        else:
+            manifest[prefix] = manifest_entry(entry)
+    return manifest
+
+
+def iter_entry(entry, file):
+    if 'chunks' in entry:
+        for chunk_hash, _ in read_chunk_list(entry['chunks'])['chunks']:
+            for block in iter_object(chunk_hash):
+                yield block
+    elif 'hash' in entry:
+        for block in iter_object(entry['hash']):
+            yield block
+    else:
+        for block in iter_file(os.path.join(entry['subdir'], file)):
+            yield block
+
+
+def read_blocks(blocks, limit=None):
+    data = bytearray()
+    for block in blocks:
+        data += block
+        if limit is not None and len(data) >= limit:
+            break
+    return bytes(data) if limit is None else bytes(data[:limit])
+
+
+def middle_split(a, b, a_start, a_end, b_start, b_end):
+    # runs Myers' search from both ends of the range at once and returns the point where a shortest
+    # edit script crosses the middle, or None once more than DIFF_MAX_COST edits are needed each way
+    n, m = a_end - a_start, b_end - b_start
+    delta = n - m
+    odd = delta % 2 == 1
+    forward = {1: 0}
+    backward = {1: 0}
+    # diagonals that left the grid are not searched again
+    forward_start = forward_end = backward_start = backward_end = 0
+    for d in range(min((n + m + 1) // 2, DIFF_MAX_COST) + 1):
+        for k in range(-d + forward_start, d + 1 - forward_end, 2):
+            if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+                x = forward[k + 1]
+            else:
+                x = forward[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_start + x] == b[b_start + y]:
+                x += 1
+                y += 1
+            forward[k] = x
+            if x > n:
+                forward_end += 2
+            elif y > m:
+                forward_start += 2
+            elif odd and delta - k in backward and x >= n - backward[delta - k]:
+                return a_start + x, b_start + y
+        for k in range(-d + backward_start, d + 1 - backward_end, 2):
+            if k == -d or (k != d and backward[k - 1] < backward[k + 1]):
+                x = backward[k + 1]
+            else:
+                x = backward[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_end - 1 - x] == b[b_end - 1 - y]:
+                x += 1
+                y += 1
+            backward[k] = x
+            if x > n:
+                backward_end += 2
+            elif y > m:
+                backward_start += 2
+            elif not odd and delta - k in forward:
+                forward_x = forward[delta - k]
+                if forward_x >= n - x:
+                    return a_start + forward_x, b_start + forward_x - delta + k
+    return None
+
+
+def myers_diff(a, b):
+    # Myers' O(ND) algorithm over lines in linear space, splitting each range at the middle of its
+    # shortest edit script; returns ('=', i, j), ('-', i, None) and ('+', None, j) edits
+    edits = []
+    # ranges are taken left to right; a range with a count of None is still to be diffed, the others
+    # are the common suffix of a range already split
+    stack = [(0, len(a), 0, len(b), None)]
+    while stack:
+        a_start, a_end, b_start, b_end, same = stack.pop()
+        if same is not None:
+            edits.extend(('=', a_start + i, b_start + i) for i in range(same))
+            continue
+        while a_start < a_end and b_start < b_end and a[a_start] == b[b_start]:
+            edits.append(('=', a_start, b_start))
+            a_start += 1
+            b_start += 1
+        suffix = 0
+        while a_start < a_end - suffix and b_start < b_end - suffix and a[a_end - 1 - suffix] == b[b_end - 1 - suffix]:
+            suffix += 1
+        a_end -= suffix
+        b_end -= suffix
+        stack.append((a_end, None, b_end, None, suffix))
+        split = None
+        if a_start < a_end and b_start < b_end:
+            split = middle_split(a, b, a_start, a_end, b_start, b_end)
+        if split is None or split in ((a_start, b_start), (a_end, b_end)):
+            # one side is empty, or the range is too expensive to diff and is replaced as a whole
+            edits.extend(('-', i, None) for i in range(a_start, a_end))
+            edits.extend(('+', None, j) for j in range(b_start, b_end))
+            continue
+        split_a, split_b = split
+        stack.append((split_a, a_end, split_b, b_end, None))
+        stack.append((a_start, split_a, b_start, split_b, None))
+    return edits
+
+
+def iter_hunks(edits, context=3):
+    # yields the edit ranges of unified diff hunks, merging changes less than 2 * context lines apart
+    changes = [position for position, edit in enumerate(edits) if edit[0] != '=']
+    group = []
+    for position in changes:
+        if group and position - group[-1] > 2 * context:
+            yield max(0, group[0] - context), min(len(edits), group[-1] + context + 1)
+            group = []
+        group.append(position)
+    if group:
+        yield max(0, group[0] - context), min(len(edits), group[-1] + context + 1)
+
+
+def write_unified_diff(a_lines, b_lines, context=3, colors=False):
+    red, green, cyan, reset = ('\033[91m', '\033[92m', '\033[96m', '\033[0m') if colors else ('', '', '', '')
+    edits = myers_diff(a_lines, b_lines)
+    position = a_start = b_start = 0
+    for start, end in iter_hunks(edits, context):
+        # lines before the hunk, which is also how an empty side is numbered
+        for tag, _, _ in edits[position:start]:
+            a_start += tag != '+'
+            b_start += tag != '-'
+        position = start
+        hunk = edits[start:end]
+        a_count = sum(1 for tag, _, _ in hunk if tag != '+')
+        b_count = sum(1 for tag, _, _ in hunk if tag != '-')
+        lines = ['{}@@ -{},{} +{},{} @@{}\n'.format(
+            cyan, a_start + (1 if a_count else 0), a_count, b_start + (1 if b_count else 0), b_count, reset)]
+        for tag, i, j in hunk:
+            if tag == '=':
+                line, prefix, color = a_lines[i], ' ', ''
+            elif tag == '-':
+                line, prefix, color = a_lines[i], '-', red
+            else:
+                line, prefix, color = b_lines[j], '+', green
+            if line.endswith('\n'):
+                lines.append('{}{}{}{}'.format(color, prefix, line[:-1], reset) + '\n')
+            else:
+                lines.append('{}{}{}{}\n\\ No newline at end of file\n'.format(color, prefix, line, reset))
+        sys.stdout.write(''.join(lines))
+
+
+def diff_file(file, old, new, context=3, colors=False):
+    # old and new are functions returning an iterator of blocks, or None for a missing side
+    old_head = read_blocks(old(), DIFF_BINARY_PROBE) if old is not None else b''
+    new_head = read_blocks(new(), DIFF_BINARY_PROBE) if new is not None else b''
+    sys.stdout.write('diff --vcontrol a/{0} b/{0}\n'.format(file[2:]))
+    if b'\0' in old_head or b'\0' in new_head:
+        sys.stdout.write('Binary files {} and {} differ\n'.format(
+            'a/' + file[2:] if old is not None else '/dev/null', 'b/' + file[2:] if new is not None else '/dev/null'))
+        return
+    old_lines = read_blocks(old()).decode('utf-8', 'replace').splitlines(True) if old is not None else []
+    new_lines = read_blocks(new()).decode('utf-8', 'replace').splitlines(True) if new is not None else []
+    sys.stdout.write('--- {}\n+++ {}\n'.format(
+        'a/' + file[2:] if old is not None else '/dev/null', 'b/' + file[2:] if new is not None else '/dev/null'))
+    write_unified_diff(old_lines, new_lines, context, colors)
+    sys.stdout.flush()
+
+
+def outside_working_tree(path):
+    # symlinks are resolved, so a linked directory cannot lead a path out of the working directory
+    first = os.path.relpath(os.path.realpath(path), os.path.realpath(WORKING_DIR)).split(os.sep)[0]
+    return first in ('..', '.vcs')
+
+
+def check_paths(paths, action):
+    for path in paths or []:
+        if outside_working_tree(path):
+            print('{} is outside the working directory or inside .vcs. {} canceled.'.format(path, action))
+            sys.exit(1)
+
+
+def normalize_paths(paths):
+    prefixes = set()
+    for path in paths:
+        relative = os.path.relpath(path, WORKING_DIR)
+        prefixes.add('.' if relative == '.' else './' + relative)
+    return prefixes
 
 
+def path_filter(paths):
+    if not paths:
+        return lambda file: True
+    prefixes = normalize_paths(paths)
+    if '.' in prefixes:
+        return lambda file: True
+    nested = tuple(prefix + '/' for prefix in prefixes)
+    return lambda file: file in prefixes or file.startswith(nested)
+
+
+@profiled('print status')
 def print_file_status(working_files, unchanged_files, deleted_files, config, primer=None):
     if primer is not None:
         print('{}:'.format(primer))
@@ -181,58 +2435,544 @@ def print_file_status(working_files, unchanged_files, deleted_files, config, pri
         for file in working_files:
             print('  {}+{} addition: {}'.format('\033[92m', '\033[0m', file))
     else:
-        last_vcs_filepath = COMMITS_PATH + '/V{:05d}_{}/.vcs'.format(config['last_commit']['value'],
-                                                                         config['last_commit']['user'])
-        vcs = read_json_file(last_vcs_filepath)
         for deleted_file in deleted_files:
             print('  {}-{} deletion: {}'.format('\033[91m', '\033[0m', deleted_file))
-        for file_path in [fp for fp in working_files if fp not in unchanged_files]:
-            if file_path not in vcs['commits']:
+        unchanged_set = set(unchanged_files)
+        changed_files = [fp for fp in working_files if fp not in unchanged_set]
+        commit_tag = format_commit_tag(config['last_commit']['value'], config['last_commit']['user'])
+        tree_hash = read_commit(commit_tag).get('tree')
+        manifest = _manifest_cache.get((os.path.abspath(COMMITS_PATH), commit_tag))
+        if manifest is None and tree_hash is None:
+            manifest = load_manifest(commit_tag)
+        for file_path in changed_files:
+            # the monitor's fast path never flattens the manifest, so single paths are looked up in the tree
+            if manifest is not None:
+                tracked = file_path in manifest
+            else:
+                tracked = tree_entry(tree_hash, file_path) is not None
+            if not tracked:
                 print('  {}+{} addition: {}'.format('\033[92m', '\033[0m', file_path))
             else:
                 print('  {}~{} change: {}'.format('\033[93m', '\033[0m', file_path))
 
 
+@profiled('fetch')
+def fetch_from_directory(target_repo_dir, peer, depth=None, lazy=False):
+    TARGET_VCS_PATH = target_repo_dir + '/.vcs'
+    TARGET_COMMIT_PATH = TARGET_VCS_PATH + '/commits'
+    target_objects_path = TARGET_VCS_PATH + '/objects'
+
+    target_config = read_json_file(TARGET_VCS_PATH + '/config.json')
+    print('fetching {} commits at {}...'.format(target_config['repo_name'], target_repo_dir))
+    if is_fetched(peer, target_config, depth):
+        return target_config, None
+
+    if depth is not None:
+        target_tags = shallow_tags(head_tags(target_config), depth, TARGET_COMMIT_PATH)
+    else:
+        target_tags = list_commit_tags(TARGET_COMMIT_PATH)
+    missing_tags = sorted(target_tags - list_commit_tags() - read_pruned_tags())
+
+    wanted_trees = []
+    wanted_blobs = set()
+    for commit_tag in missing_tags:
+        commit = read_commit(commit_tag, TARGET_COMMIT_PATH)
+        if 'tree' in commit:
+            # a tree already present locally is complete, so its subtrees are not walked
+            collect_tree_objects(commit['tree'], target_objects_path, has_object, wanted_trees, wanted_blobs)
+        else:
+            wanted_blobs.update(entry['hash'] for entry in commit['commits'].values() if 'hash' in entry)
+    if lazy:
+        # file contents stay with the peer until a revert or diff reads them
+        wanted_blobs = set()
+    missing_objects = [object_hash for object_hash in wanted_blobs if not has_object(object_hash)] + wanted_trees
+
+    # packs hold blobs too, so a lazy fetch copies the trees one by one instead
+    copied_packs = [] if lazy else copy_packs(missing_objects, target_objects_path)
+    try:
+        parallel_map(lambda object_hash: fetch_object(object_hash, target_objects_path),
+                     [object_hash for object_hash in wanted_blobs if not has_object(object_hash)],
+                     DEFAULT_JOBS)
+        # trees are stored after their children so a present tree always implies its contents
+        for tree_hash in wanted_trees:
+            if not has_object(tree_hash):
+                fetch_object(tree_hash, target_objects_path)
+
+        # commits are published only once every object they reference is present
+        for commit_tag in missing_tags:
+            tmp = '{}/.{}.tmp{}'.format(COMMITS_PATH, commit_tag, os.getpid())
+            shutil.copytree(src=TARGET_COMMIT_PATH + '/{}'.format(commit_tag), dst=tmp)
+            publish_directory(tmp, COMMITS_PATH + '/{}'.format(commit_tag))
+    finally:
+        release_packs(copied_packs)
+    return target_config, {'commits': len(missing_tags), 'objects': len(missing_objects), 'packs': copied_packs,
+                           'tags': missing_tags, 'received': missing_objects}
+
+
+def send_message(writer, message):
+    writer.write(json.dumps(message).encode() + b'\n')
+
+
+async def send_stream(writer, blocks):
+    # length-prefixed chunks ended by an empty one; draining after each chunk applies backpressure
+    for block in blocks:
+        if block:
+            writer.write(WIRE_CHUNK.pack(len(block)) + block)
+            await writer.drain()
+    writer.write(WIRE_CHUNK.pack(0))
+    await writer.drain()
+
+
+async def read_message(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError('peer closed the connection')
+    message = json.loads(line.decode())
+    if 'error' in message:
+        raise ValueError('peer refused the request: {}'.format(message['error']))
+    return message
+
+
+def is_object_hash(value):
+    return isinstance(value, str) and OBJECT_HASH_PATTERN.fullmatch(value) is not None
+
+
+def is_commit_tag(value):
+    return isinstance(value, str) and COMMIT_TAG_PATTERN.fullmatch(value) is not None
+
+
+def staged_path(staging_dir, path):
+    # a path sent by a peer must stay inside the directory it is staged in
+    root = os.path.normpath(staging_dir)
+    target = os.path.normpath(os.path.join(root, path))
+    if not isinstance(path, str) or os.path.isabs(path) or not target.startswith(root + os.sep):
+        raise ValueError('peer sent an invalid path {}'.format(path))
+    return target
+
+
+async def read_stream(reader):
+    while True:
+        size, = WIRE_CHUNK.unpack(await reader.readexactly(WIRE_CHUNK.size))
+        if size == 0:
+            return
+        yield await reader.readexactly(size)
+
+
+def iter_file(filename):
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            yield block
+
+
+async def refuse_request(writer, error):
+    send_message(writer, {'error': error})
+    await writer.drain()
+
+
+async def serve_peer(reader, writer):
+    import asyncio
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line.decode())
+            except ValueError:
+                await refuse_request(writer, 'malformed request')
+                break
+            if request['cmd'] == 'hello':
+                config = read_config_file()
+                if request.get('depth') is not None:
+                    tags = shallow_tags(head_tags(config), request['depth'])
+                else:
+                    tags = list_commit_tags()
+                send_message(writer, {'config': config, 'tags': sorted(tags)})
+                await writer.drain()
+            elif request['cmd'] == 'commits':
+                # only commits of this repository are served; anything else would be a path into it
+                commit_tags = list_commit_tags()
+                invalid = [commit_tag for commit_tag in request['tags'] if commit_tag not in commit_tags]
+                if invalid:
+                    await refuse_request(writer, 'unknown commit {}'.format(invalid[0]))
+                    break
+                for commit_tag in request['tags']:
+                    commit_dir = '{}/{}'.format(COMMITS_PATH, commit_tag)
+                    for dirpath, _, filenames in os.walk(commit_dir):
+                        for filename in filenames:
+                            path = os.path.join(dirpath, filename)
+                            send_message(writer, {'tag': commit_tag, 'path': os.path.relpath(path, commit_dir)})
+                            await send_stream(writer, iter_file(path))
+                send_message(writer, {'done': True})
+                await writer.drain()
+            elif request['cmd'] == 'objects':
+                invalid = [object_hash for object_hash in request['hashes'] if not is_object_hash(object_hash)]
+                if invalid:
+                    await refuse_request(writer, 'invalid object hash {}'.format(invalid[0]))
+                    break
+                # a lazily fetched repository passes on what it has not downloaded yet, off the event
+                # loop so other peers are still served meanwhile
+                await asyncio.get_running_loop().run_in_executor(None, fetch_missing_objects, request['hashes'])
+                for object_hash in request['hashes']:
+                    if not has_object(object_hash):
+                        send_message(writer, {'hash': object_hash, 'missing': True})
+                        continue
+                    send_message(writer, {'hash': object_hash})
+                    await send_stream(writer, iter_object(object_hash))
+                await writer.drain()
+            else:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    except (KeyError, TypeError, ValueError):
+        # a malformed request ends the connection rather than the server
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    # every message is one JSON line, and the hello reply lists all commits
+    import asyncio
+    server = await asyncio.start_server(serve_peer, host, port, limit=WIRE_LINE_LIMIT)
+    print('serving {} on tcp://{}:{}'.format(read_config_file()['repo_name'], host, port))
+    async with server:
+        await server.serve_forever()
+
+
+async def receive_object(reader, object_hash, objects_path=OBJECTS_PATH):
+    if not is_object_hash(object_hash):
+        raise ValueError('peer sent an invalid object hash {}'.format(object_hash))
+    dst = object_path(object_hash, objects_path)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = '{}.tmp{}_{}'.format(dst, os.getpid(), threading.get_ident())
+    sha = hashlib.sha1()
+    with open(tmp, 'wb') as f:
+        async for block in read_stream(reader):
+            sha.update(block)
+            f.write(block)
+    if sha.hexdigest() != object_hash:
+        os.remove(tmp)
+        raise ValueError('object {} was corrupted in transfer'.format(object_hash))
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, dst)
+
+
+async def fetch_from_server_async(host, port, peer, depth=None, lazy=False):
+    import asyncio
+    reader, writer = await asyncio.open_connection(host, port, limit=WIRE_LINE_LIMIT)
+    staged = {}
+    try:
+        send_message(writer, {'cmd': 'hello', 'depth': depth})
+        await writer.drain()
+        hello = await read_message(reader)
+        target_config = hello['config']
+        print('fetching {} commits at tcp://{}:{}...'.format(target_config['repo_name'], host, port))
+        if is_fetched(peer, target_config, depth):
+            return target_config, None
+
+        # tags and paths from the peer become paths here, so none may leave the commits directory
+        invalid = [commit_tag for commit_tag in hello['tags'] if not is_commit_tag(commit_tag)]
+        if invalid:
+            raise ValueError('peer sent an invalid commit tag {}'.format(invalid[0]))
+        missing_tags = sorted(set(hello['tags']) - list_commit_tags() - read_pruned_tags())
+        # requests go in batches, one in flight at a time, so no line grows with the history
+        for start in range(0, len(missing_tags), WIRE_BATCH_SIZE):
+            batch = missing_tags[start:start + WIRE_BATCH_SIZE]
+            send_message(writer, {'cmd': 'commits', 'tags': batch})
+            await writer.drain()
+            batch = set(batch)
+            while True:
+                header = await read_message(reader)
+                if header.get('done'):
+                    break
+                if header['tag'] not in batch:
+                    raise ValueError('peer sent commit {} which was not requested'.format(header['tag']))
+                if header['tag'] not in staged:
+                    staged[header['tag']] = '{}/.{}.tmp{}'.format(COMMITS_PATH, header['tag'], os.getpid())
+                path = staged_path(staged[header['tag']], header['path'])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    async for block in read_stream(reader):
+                        f.write(block)
+
+        # walk the peer's trees one level per round trip; blobs found at a level are
+        # requested in the same batch as the next level's trees
+        roots = set()
+        level = []
+        for commit_tag in missing_tags:
+            commit = read_json_file(staged[commit_tag] + '/.vcs')
+            if 'tree' in commit:
+                roots.add(commit['tree'])
+                level.append(commit['tree'])
+            elif not lazy:
+                level.extend(entry['hash'] for entry in commit['commits'].values() if 'hash' in entry)
+        invalid = [object_hash for object_hash in level if not is_object_hash(object_hash)]
+        if invalid:
+            raise ValueError('peer sent an invalid object hash {}'.format(invalid[0]))
+        trees = {}
+        tree_order = []
+        requested = set()
+        fetched = 0
+        wanted = [object_hash for object_hash in dict.fromkeys(level) if not has_object(object_hash)]
+        pending = dict((tree_hash, 'tree') for tree_hash in roots)
+        while wanted:
+            requested.update(wanted)
+            next_pending = {}
+            wanted_next = []
+            for position in range(len(wanted)):
+                if position % WIRE_BATCH_SIZE == 0:
+                    send_message(writer, {'cmd': 'objects', 'hashes': wanted[position:position + WIRE_BATCH_SIZE]})
+                    await writer.drain()
+                header = await read_message(reader)
+                if header.get('missing'):
+                    raise ValueError('peer is missing object {}'.format(header['hash']))
+                object_hash = header['hash']
+                if object_hash not in requested:
+                    raise ValueError('peer sent object {} which was not requested'.format(object_hash))
+                fetched += 1
+                if object_hash not in pending:
+                    await receive_object(reader, object_hash)
+                    continue
+                data = b''.join([block async for block in read_stream(reader)])
+                if hashlib.sha1(data).hexdigest() != object_hash:
+                    raise ValueError('object {} was corrupted in transfer'.format(object_hash))
+                trees[object_hash] = data
+                tree_order.append(object_hash)
+                parsed = json.loads(data.decode())
+                if pending[object_hash] == 'chunks':
+                    children = [(chunk_hash, None) for chunk_hash, _ in parsed['chunks']]
+                else:
+                    children = []
+                    for entry in parsed.values():
+                        if 'chunks' in entry:
+                            children.append((entry['chunks'], 'chunks'))
+                        else:
+                            children.append((entry['hash'], 'tree' if entry['type'] == 'tree' else None))
+                for child_hash, kind in children:
+                    if not is_object_hash(child_hash):
+                        raise ValueError('tree {} has an invalid object hash'.format(object_hash))
+                    # a lazy fetch only walks trees and chunk lists, leaving the blobs on the peer
+                    if child_hash in requested or (lazy and kind is None) or has_object(child_hash):
+                        continue
+                    requested.add(child_hash)
+                    wanted_next.append(child_hash)
+                    if kind is not None:
+                        next_pending[child_hash] = kind
+            pending = next_pending
+            wanted = wanted_next
+
+        # trees are stored after their children so a present tree always implies its contents
+        for tree_hash in reversed(tree_order):
+            store_object_data(trees[tree_hash])
+        for commit_tag in missing_tags:
+            publish_directory(staged[commit_tag], COMMITS_PATH + '/{}'.format(commit_tag))
+        send_message(writer, {'cmd': 'bye'})
+        await writer.drain()
+        return target_config, {'commits': len(missing_tags), 'objects': fetched, 'packs': [], 'tags': missing_tags,
+                               'received': sorted(requested)}
+    finally:
+        writer.close()
+        # commits of a failed fetch are staged but never published
+        for tmp in staged.values():
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+@profiled('fetch')
+def fetch_from_server(url, peer, depth=None, lazy=False):
+    import asyncio
+    address = urllib.parse.urlsplit(url)
+    return asyncio.run(fetch_from_server_async(address.hostname, address.port or DEFAULT_PORT, peer, depth, lazy))
+
+
+async def request_objects_async(host, port, object_hashes, objects_path=OBJECTS_PATH):
+    import asyncio
+    reader, writer = await asyncio.open_connection(host, port, limit=WIRE_LINE_LIMIT)
+    try:
+        for position in range(len(object_hashes)):
+            if position % WIRE_BATCH_SIZE == 0:
+                send_message(writer, {'cmd': 'objects', 'hashes': object_hashes[position:position + WIRE_BATCH_SIZE]})
+                await writer.drain()
+            header = await read_message(reader)
+            if not header.get('missing'):
+                await receive_object(reader, header['hash'], objects_path)
+        send_message(writer, {'cmd': 'bye'})
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+@profiled('fetch on demand')
+def fetch_missing_objects(object_hashes, objects_path=OBJECTS_PATH):
+    # downloads objects a lazy fetch left with its peers into this repository; returns how many arrived
+    if os.path.abspath(objects_path) != os.path.abspath(OBJECTS_PATH) or not os.path.exists(CONFIG_PATH):
+        return 0
+    promisors = read_config_file().get('promisors', [])
+    if not promisors:
+        return 0
+    missing = [object_hash for object_hash in dict.fromkeys(object_hashes) if not has_object(object_hash, objects_path)]
+    fetched = 0
+    for promisor in promisors:
+        if not missing:
+            break
+        print('fetching {} object(s) from {}...'.format(len(missing), promisor), file=sys.stderr)
+        try:
+            if promisor.startswith('tcp://'):
+                import asyncio
+                from concurrent.futures import ThreadPoolExecutor
+                address = urllib.parse.urlsplit(promisor)
+                # a worker thread, as this may be called from inside the daemon's or server's event loop
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    executor.submit(asyncio.run, request_objects_async(
+                        address.hostname, address.port or DEFAULT_PORT, missing, objects_path)).result()
+            else:
+                source = promisor + '/.vcs/objects'
+                parallel_map(lambda object_hash: fetch_object(object_hash, source, objects_path),
+                             [object_hash for object_hash in missing if has_object(object_hash, source)], DEFAULT_JOBS)
+        except (OSError, ValueError) as exception:
+            print('fetch from {} failed: {}'.format(promisor, exception), file=sys.stderr)
+        still_missing = [object_hash for object_hash in missing if not has_object(object_hash, objects_path)]
+        fetched += len(missing) - len(still_missing)
+        missing = still_missing
+    count('objects fetched on demand', fetched)
+    return fetched
+
+
+def prefetch_entries(entries):
+    # one batched request for everything a revert or diff is about to read; returns the hashes still
+    # missing, so a revert can stop before it has changed anything
+    object_hashes = []
+    for entry in entries:
+        if 'chunks' in entry:
+            object_hashes.extend(chunk_hash for chunk_hash, _ in read_chunk_list(entry['chunks'])['chunks'])
+        elif 'hash' in entry:
+            object_hashes.append(entry['hash'])
+    if read_config_file().get('promisors'):
+        fetch_missing_objects(object_hashes)
+    return [object_hash for object_hash in object_hashes if not has_object(object_hash)]
+
+
+def is_fetched(peer, target_config, depth=None):
+    # a shallow repository is never up to date, so fetching again can bring in the rest of the history
+    target_latest_tag = format_commit_tag(target_config['last_commit']['value'], target_config['last_commit']['user'])
+    return depth is None and peer.get('commit') == target_latest_tag \
+        and os.path.exists(COMMITS_PATH + '/' + target_latest_tag) and not read_shallow_tags()
+
+
 def fetch_command(args):
     if not os.path.exists(VCS_PATH):
         print("Repository has not been intialized, or isn't detected. Run 'vcontrol create [repo_name] [username]'")
         sys.exit(1)
 
-    if not os.path.exists(args.dir):
-        print("Target vcontrol repository directory does not exist and therefore commits cannot be fetched.")
+    if args.depth is not None and args.depth < 1:
+        print("Fetch depth must be at least 1.")
         sys.exit(1)
 
-    TARGET_REPO_DIR = args.dir.strip('/')
-    TARGET_VCS_PATH = TARGET_REPO_DIR + '/.vcs'
-    TARGET_COMMIT_PATH = TARGET_VCS_PATH + '/commits'
-
-    if not os.path.exists(TARGET_VCS_PATH):
-        print("Target vcontrol repository has not been intialized.")
-        sys.exit(1)
+    config = read_config_file()
+    last_fetch = config['last_fetch'] if isinstance(config['last_fetch'], dict) else {}
+    lazy = args.lazy
+    promisors = []
+
+    if args.dir.startswith('tcp://'):
+        peer = args.dir
+        try:
+            target_config, stats = fetch_from_server(args.dir, last_fetch.get(peer, {}), args.depth, lazy)
+        except (OSError, ValueError) as exception:
+            print('Fetch from {} failed: {}'.format(args.dir, exception))
+            sys.exit(1)
+    else:
+        if not os.path.exists(args.dir):
+            print("Target vcontrol repository directory does not exist and therefore commits cannot be fetched.")
+            sys.exit(1)
 
-    target_config = read_json_file(TARGET_VCS_PATH + '/config.json')
+        TARGET_REPO_DIR = args.dir.rstrip('/')
+        if not os.path.exists(TARGET_REPO_DIR + '/.vcs'):
+            print("Target vcontrol repository has not been intialized.")
+            sys.exit(1)
 
-    print('fetching {} commits at {}...'.format(target_config['repo_name'], TARGET_REPO_DIR))
+        peer = os.path.abspath(TARGET_REPO_DIR)
+        # contents a lazy peer has not downloaded can only come from its own peers, so this fetch is lazy too
+        promisors = read_json_file(TARGET_REPO_DIR + '/.vcs/config.json').get('promisors', [])
+        lazy = lazy or bool(promisors)
+        target_config, stats = fetch_from_directory(TARGET_REPO_DIR, last_fetch.get(peer, {}), args.depth, lazy)
 
-    for commit_subdir in os.listdir(TARGET_COMMIT_PATH):
-        shutil.copytree(src=TARGET_COMMIT_PATH + '/{}'.format(commit_subdir),
-                        dst=COMMITS_PATH + '/{}'.format(commit_subdir))
+    target_latest_tag = format_commit_tag(target_config['last_commit']['value'], target_config['last_commit']['user'])
+    if stats is None:
+        print('Already up to date with {} on tag {}.'.format(target_config['repo_name'], target_latest_tag))
+    else:
+        print('  {} new commit(s), {} new object(s), {} pack(s) copied'.format(stats['commits'], stats['objects'], len(stats['packs'])))
+        if args.check:
+            check_fetched(stats)
+        with repository_lock():
+            if update_shallow_tags(stats['tags']) and os.path.exists(COMMIT_GRAPH_PATH):
+                # commits that were shallow now have parents, which changes their generations and changed paths
+                os.remove(COMMIT_GRAPH_PATH)
+            update_commit_graph()
+            # re-read, as a commit may have moved last_commit while the objects were transferred
+            config = read_config_file()
+            last_fetch = config['last_fetch'] if isinstance(config['last_fetch'], dict) else {}
+            last_fetch[peer] = {
+                'repo_name': target_config['repo_name'],
+                'commit': target_latest_tag
+            }
+            config['last_fetch'] = last_fetch
+            if lazy:
+                config['promisors'] = config.get('promisors', [])
+                for promisor in [peer] + promisors:
+                    if promisor not in config['promisors']:
+                        config['promisors'].append(promisor)
+            update_config_file(config)
 
     print('fetch complete! Commits from repository {} available in this repository'.format(target_config['repo_name']))
 
     if args.revert:
-        confirm = input('Revert flag is set, revert to commit {}? You will lose uncommited changes in your working directory. (y/N)\n'.format(args.commit_tag))
+        confirm = input('Revert flag is set, revert to commit {}? You will lose uncommited changes in your working directory. (y/N)\n'.format(target_latest_tag))
         if confirm != 'y':
             if confirm != 'N':
                 print('Invalid input...')
             print('Canceling revert.')
             sys.exit(1)
 
-        target_config = read_json_file(TARGET_VCS_PATH + '/config.json')
+        with repository_lock():
+            revert(target_latest_tag, WORKING_DIR, COMMITS_PATH)
 
-        revert('V{:05d}_{}'.format(target_config['last_commit']['value'], target_config['last_commit']['user']),
-               WORKING_DIR,
-               COMMITS_PATH)
+
+def check_fetched(stats):
+    # runs before the fetch is recorded, so a failed check leaves the repository as it was
+    result = fsck(stats['tags'], DEFAULT_JOBS, set(stats['received']), sys.stderr.isatty())
+    if not result['problems']:
+        print('  checked {} new object(s), {:.1f} MB'.format(result['objects'], result['bytes'] / 1e6))
+        return
+    for problem in result['problems']:
+        print('  {}!{} {}'.format('\033[91m', '\033[0m', problem))
+    # corrupt objects would otherwise count as present and never be fetched again; the copied packs
+    # only add to what was here before, as packs with a known name are never copied
+    with repository_lock():
+        for commit_tag in stats['tags']:
+            shutil.rmtree(os.path.join(COMMITS_PATH, commit_tag), ignore_errors=True)
+            _commit_cache.pop((os.path.abspath(COMMITS_PATH), commit_tag), None)
+            _manifest_cache.pop((os.path.abspath(COMMITS_PATH), commit_tag), None)
+        for object_hash in result['corrupt']:
+            if os.path.exists(object_path(object_hash)):
+                os.remove(object_path(object_hash))
+        for name in stats['packs']:
+            for extension in ['.idx', '.pack']:
+                os.remove('{}/{}{}'.format(PACKS_PATH, name, extension))
+        forget_packs()
+    print('Fetch check found {} problem(s). The fetched commits were removed, fetch again to retry.'.format(len(result['problems'])))
+    sys.exit(1)
+
+
+def serve_command(args):
+    import asyncio
+    if not os.path.exists(VCS_PATH):
+        print("Repository has not been intialized, or isn't detected. Run 'vcontrol create [repo_name] [username]'")
+        sys.exit(1)
+
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print('server stopped.')
 
 
 def info_command(args):
@@ -240,13 +2980,15 @@ def info_command(args):
         print("Repository has not been intialized, or isn't detected. Run 'vcontrol create [repo_name] [username]'")
         sys.exit(1)
 
-    working_files = get_file_paths('.', ['.vcs'])
     config = read_config_file()
     last_commit_tag = 'V{:05d}_{}'.format(config['last_commit']['value'], config['last_commit']['user'])
     print('In repository {} --> commit tag {}'.format(config['repo_name'], last_commit_tag))
 
-    unchanged_files, deleted_files = get_unchanged_deleted_files(working_files, config)
-    if unchanged_files == working_files and not deleted_files:
+    index = read_index()
+    working_files, changed, entries = scan_working_files(index, ['.vcs'])
+    unchanged_files, deleted_files, _ = get_unchanged_deleted_files(working_files, config, index, DEFAULT_JOBS, changed, entries)
+    write_index(index, working_files)
+    if len(unchanged_files) == len(working_files) and not deleted_files:
         print("Working directory is clean - no changes.")
     else:
         print_file_status(working_files, unchanged_files, deleted_files, config, 'info')
@@ -258,14 +3000,338 @@ def revert_command(args):
         print("Repository has not been intialized, or isn't detected. Run 'vcontrol create [repo_name] [username]'")
         sys.exit(1)
 
-    confirm = input('Revert to commit {}? You will lose uncommited changes in your working directory. (y/N)\n'.format(args.commit_tag))
+    check_paths(args.paths, 'Revert')
+    if args.paths:
+        confirm = input('Revert {} to commit {}? You will lose uncommited changes to them. (y/N)\n'.format(', '.join(args.paths), args.commit_tag))
+    else:
+        confirm = input('Revert to commit {}? You will lose uncommited changes in your working directory. (y/N)\n'.format(args.commit_tag))
     if confirm != 'y':
         if confirm != 'N':
             print('Invalid input...')
         print('Canceling revert.')
         sys.exit(1)
 
-    revert(args.commit_tag, WORKING_DIR, COMMITS_PATH)
+    with repository_lock():
+        revert(args.commit_tag, WORKING_DIR, COMMITS_PATH, args.paths)
+
+
+def log_command(args):
+    if not os.path.exists(VCS_PATH):
+        print("Repository has not been intialized, or isn't detected. Run 'vcontrol create [repo_name] [username]'")
+        sys.exit(1)
+
+    config = read_config_file()
+    graph = update_commit_graph()['commits']
+
+    path = None
+    if args.path is not None and os.path.relpath(args.path, WORKING_DIR) != '.':
+        path = './' + os.path.relpath(args.path, WORKING_DIR)
+
+    if args.all:
+        heads = list(graph)
+    else:
+        heads = [format_commit_tag(config['last_commit']['value'], config['last_commit']['user'])]
+    queue = [(-graph[tag]['generation'], -graph[tag]['timestamp'], tag) for tag in heads if tag in graph]
+    heapq.heapify(queue)
+    seen = set(tag for _, _, tag in queue)
+
+    shallow = read_shallow_tags()
+    listed = 0
+    while queue and (args.max_count is None or listed < args.max_count):
+        _, _, commit_tag = heapq.heappop(queue)
+        node = graph[commit_tag]
+        for parent in node['parents']:
+            if parent not in seen:
+                seen.add(parent)
+                heapq.heappush(queue, (-graph[parent]['generation'], -graph[parent]['timestamp'], parent))
+
+        changed = node['changed']
+        if path is not None:
+            changed = [file for file in changed if file == path or file.startswith(path + '/')]
+            if not changed:
+                continue
+        listed += 1
+        print('{}*{} {} | {} | {} file(s) changed{}{}'.format(
+            '\033[93m', '\033[0m', commit_tag,
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(node['timestamp'])),
+            len(changed),
+            ' | parents: ' + ', '.join(node['parents']) if node['parents'] else '',
+            ' | shallow, older history not fetched' if commit_tag in shallow else ''))
+        if path is not None:
+            for file in changed:
+                print('    {}'.format(file))
+
+
+def diff_entries(entry_a, entry_b):
+    if 'hash' in entry_a and 'hash' in entry_b:
+        return entry_a['hash'] != entry_b['hash']
+    return entry_a['value'] != entry_b['value'] or entry_a['user'] != entry_b['user']
+
+
+def diff_commits(tag_a, tag_b, matches, context, colors):
+    commit_a = read_commit(tag_a)
+    commit_b = read_commit(tag_b)
+    if 'tree' in commit_a and 'tree' in commit_b:
+        # identical subtrees are skipped by hash, so only the changed files are ever looked up
+        files = sorted(file for file in diff_trees(commit_a['tree'], commit_b['tree']) if matches(file))
+        entries = [(file, tree_entry(commit_a['tree'], file), tree_entry(commit_b['tree'], file)) for file in files]
+    else:
+        manifest_a = load_manifest(tag_a)
+        manifest_b = load_manifest(tag_b)
+        files = sorted(file for file in set(manifest_a) | set(manifest_b) if matches(file)
+                       and (file not in manifest_a or file not in manifest_b
+                            or diff_entries(manifest_a[file], manifest_b[file])))
+        entries = [(file, manifest_a.get(file), manifest_b.get(file)) for file in files]
+    prefetch_entries(entry for _, entry_a, entry_b in entries for entry in (entry_a, entry_b) if entry is not None)
+    for file, entry_a, entry_b in entries:
+        diff_file(file,
+                  (lambda entry=entry_a, file=file: iter_entry(entry, file)) if entry_a is not None else None,
+                  (lambda entry=entry_b, file=file: iter_entry(entry, file)) if entry_b is not None else None,
+                  context, colors)
+
+
+def diff_working_tree(commit_tag, matches, context, colors):
+    index = read_index()
+    working_files, changed, entries = scan_working_files(index, ['.vcs'])
+    manifest = load_manifest(commit_tag) if commit_tag is not None else {}
+    files = [file for file in working_files if matches(file)]
+    working_set = set(working_files)
+
+    def is_changed(file):
+        entry = manifest.get(file)
+        if entry is None:
+            return True
+        if 'hash' in entry:
+            # the stat cache answers for files whose size and mtime did not move
+            return indexed_hash(file, index, changed is not None and file not in changed, entries.get(file)) != entry['hash']
+        return not filecmp.cmp(file, os.path.join(entry['subdir'], file))
+
+    changed_flags = parallel_map(is_changed, files, DEFAULT_JOBS)
+    write_index(index, working_files)
+    differing = [file for file, flag in zip(files, changed_flags) if flag]
+    sparse = read_sparse_checkout()
+    differing += [file for file in manifest if file not in working_set and matches(file) and (sparse is None or sparse(file))]
+    prefetch_entries(manifest[file] for file in differing if file in manifest)
+    for file in sorted(differing):
+        entry = manifest.get(file)
+        diff_file(file,
+                  (lambda entry=entry, file=file: iter_entry(entry, file)) if entry is not None else None,
+                  (lambda file=file: iter_file(file)) if file in working_set else None,
+                  context, colors)
+
+
+def diff_command(args):
+    if not os.path.exists(VCS_PATH):
+        print("Repository has not been intialized, or isn't detected. Run 'vcontrol create [repo_name] [username]'")
+        sys.exit(1)
+
+    # leading arguments naming commits are revisions, everything after them is a path
+    commit_tags = list_commit_tags()
+    items = list(args.args)
+    revisions = []
+    while items and len(revisions) < 2 and items[0] in commit_tags:
+        revisions.append(items.pop(0))
+    if items and items[0].startswith('V') and not os.path.exists(items[0]):
+        try:
+            parse_commit_tag(items[0])
+            print('Commit tag {} does not exist.'.format(items[0]))
+            sys.exit(1)
+        except ValueError:
+            pass
+    check_paths(items, 'Diff')
+    matches = path_filter(items)
+    colors = sys.stdout.isatty()
+
+    if len(revisions) == 2:
+        diff_commits(revisions[0], revisions[1], matches, args.context, colors)
+        return
+    if not revisions:
+        config = read_config_file()
+        if config['last_commit']['value'] != 0:
+            revisions.append(format_commit_tag(config['last_commit']['value'], config['last_commit']['user']))
+    diff_working_tree(revisions[0] if revisions else None, matches, args.context, colors)
+
+
+class BlockReader(object):
+    # a file object over an iterator of blocks, holding at most one block beyond what was asked for
+
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            block = next(self.blocks, None)
+            if block is None:
+                break
+            self.buffer += block
+        if size < 0 or size > len(self.buffer):
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def entry_size(entry, file):
+    if 'chunks' in entry:
+        return read_chunk_list(entry['chunks'])['size']
+    if 'hash' in entry:
+        return object_size(entry['hash'])
+    return os.path.getsize(os.path.join(entry['subdir'], file))
+
+
+def export_format(output):
+    for extension, archive_format in [('.tar.gz', 'tar.gz'), ('.tgz', 'tar.gz'), ('.tar.zst', 'tar.zst'),
+                                      ('.tzst', 'tar.zst'), ('.zip', 'zip')]:
+        if output is not None and output.endswith(extension):
+            return archive_format
+    return 'tar'
+
+
+@profiled('export')
+def export_archive(manifest, output, archive_format, mtime):
+    # file contents go straight from the object store into the archive, one block at a time
+    import tarfile
+    import zipfile
+    files = sorted(manifest)
+    if archive_format == 'zip':
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for file in files:
+                info = zipfile.ZipInfo(file[2:], time.localtime(mtime)[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                # sizes are written after the data, so only chunked files can need zip64
+                with archive.open(info, 'w', force_zip64='chunks' in manifest[file]) as f:
+                    for block in iter_entry(manifest[file], file):
+                        f.write(block)
+        return len(files)
+
+    with contextlib.ExitStack() as stack:
+        if archive_format == 'tar.zst':
+            output = stack.enter_context(zstandard.ZstdCompressor().stream_writer(output, closefd=False))
+        mode = 'w|gz' if archive_format == 'tar.gz' else 'w|'
+        archive = stack.enter_context(tarfile.open(fileobj=output, mode=mode))
+        for file in files:
+            # a tar header comes before the data, so the size is looked up first
+            info = tarfile.TarInfo(file[2:])
+            info.size = entry_size(manifest[file], file)
+            info.mtime = mtime
+            info.mode = 0o644
+            archive.addfile(info, BlockReader(iter_entry(manifest[file], file)))
+    return len(files)
+
+
+def export_command(args):
+    if not os.path.exists(VCS_PATH):
+        print("Repository has not been intialized, or isn't detected. Run 'vcontrol create [repo_name] [username]'")
+        sys.exit(1)
+
+    if args.commit_tag not in list_commit_tags():
+        print('Commit tag {} does not exist.'.format(args.commit_tag))
+        sys.exit(1)
+    check_paths(args.paths, 'Export')
+    output = None if args.output == '-' else args.output
+    archive_format = args.format or export_format(output)
+    if archive_format == 'tar.zst' and zstandard is None:
+        print('zstd compression needs the zstandard package, e.g. pip install zstandard')
+        sys.exit(1)
+    if output is None and sys.stdout.isatty():
+        print('Refusing to write an archive to a terminal, use -o FILE or a pipe.')
+        sys.exit(1)
+
+    manifest = load_manifest_paths(args.commit_tag, args.paths) if args.paths else load_manifest(args.commit_tag)
+    missing = prefetch_entries(manifest.values())
+    if missing:
+        print('{} object(s) are missing, see vcontrol fsck. Export canceled.'.format(len(missing)))
+        sys.exit(1)
+
+    mtime = commit_timestamp(args.commit_tag)
+    if output is None:
+        sys.stdout.flush()
+        export_archive(manifest, sys.stdout.buffer, archive_format, mtime)
+        sys.stdout.buffer.flush()
+        return
+    try:
+        f = open(output, 'wb')
+    except OSError as exception:
+        print('Cannot write {}: {}'.format(output, exception.strerror))
+        sys.exit(1)
+    with f:
+        try:
+            exported = export_archive(manifest, f, archive_format, mtime)
+        except BaseException:
+            # a partial archive is worse than none for a pipeline picking it up
+            os.remove(output)
+            raise
+    print('Exported {} file(s) from {} to {}.'.format(exported, args.commit_tag, output))
+
+
+def repack_command(args):
+    if not os.path.exists(VCS_PATH):
+        print("Repository has not been intialized, or isn't detected. Run 'vcontrol create [repo_name] [username]'")
+        sys.exit(1)
+
+    max_delta_depth = args.depth
+    if max_delta_depth is None:
+        max_delta_depth = read_config_file().get('max_delta_depth', DEFAULT_MAX_DELTA_DEPTH)
+
+    with repository_lock():
+        # an explicit depth with --all rewrites the existing pack, whose chains were built with the old one
+        name, count, delta_count = repack(all_packs=args.all, max_delta_depth=max_delta_depth,
+                                          rewrite=args.all and args.depth is not None)
+    if name is None:
+        print("Nothing to repack.")
+        return
+    print('Packed {} object(s) into {}, {} stored as deltas'.format(count, name, delta_count))
+
+
+def gc_command(args):
+    if not os.path.exists(VCS_PATH):
+        print("Repository has not been intialized, or isn't detected. Run 'vcontrol create [repo_name] [username]'")
+        sys.exit(1)
+
+    since = None
+    if args.since is not None:
+        try:
+            since = parse_date(args.since)
+        except ValueError as exception:
+            print(exception)
+            sys.exit(1)
+
+    with repository_lock():
+        result = gc(keep=args.keep, since=since, expire=0 if args.prune_now else GC_GRACE_SECONDS,
+                    jobs=args.jobs, dry_run=args.dry_run)
+    for commit_tag in result['commits']:
+        print('  {}-{} {}: {}'.format('\033[91m', '\033[0m', 'would prune' if args.dry_run else 'prune', commit_tag))
+    for name in result['partial']:
+        print('  {}-{} {}: {}'.format('\033[91m', '\033[0m', 'would remove partial commit' if args.dry_run else 'remove partial commit', name))
+    if args.dry_run:
+        print('{} commit(s) kept, {} unreachable object(s) would be removed.'.format(result['kept_commits'], result['objects']))
+        return
+    print('{} commit(s) kept, {} unreachable object(s) removed, {} bytes freed.'.format(
+        result['kept_commits'], result['objects'], result['freed']))
+
+
+def fsck_command(args):
+    if not os.path.exists(VCS_PATH):
+        print("Repository has not been intialized, or isn't detected. Run 'vcontrol create [repo_name] [username]'")
+        sys.exit(1)
+
+    commit_tags = list_commit_tags()
+    progress = sys.stderr.isatty() if args.progress is None else args.progress
+    result = fsck(commit_tags, args.jobs, progress=progress)
+    # commit and fetch publish by rename, so a directory without a manifest was interrupted, not damaged
+    for name in sorted(os.listdir(COMMITS_PATH)) if os.path.exists(COMMITS_PATH) else []:
+        if name not in commit_tags:
+            print('  {}?{} incomplete commit directory {} (vcontrol gc removes it)'.format('\033[93m', '\033[0m', name))
+    for problem in result['problems']:
+        print('  {}!{} {}'.format('\033[91m', '\033[0m', problem))
+    print('{} commit(s), {} object(s), {:.1f} MB checked{}: {} problem(s).'.format(
+        result['commits'], result['objects'], result['bytes'] / 1e6,
+        ', {} not downloaded by a lazy fetch'.format(result['promised']) if result['promised'] else '',
+        len(result['problems'])))
+    if result['problems']:
+        sys.exit(1)
 
 
 def commit_command(args):
@@ -274,7 +3340,8 @@ def commit_command(args):
         sys.exit(1)
 
     args.ignore.append('.vcs')
-    working_files = get_file_paths('.', args.ignore)
+    index = read_index()
+    working_files, changed, entries = scan_working_files(index, args.ignore)
 
     #if not working_files:
     #    print("No files exist to be commited.")
@@ -288,25 +3355,42 @@ def commit_command(args):
 
     print('Creating new commit {} --> {}'.format(last_commit_tag, new_commit_tag))
 
-    unchanged_files, deleted_files = get_unchanged_deleted_files(working_files, config)
+    unchanged_files, deleted_files, file_hashes = get_unchanged_deleted_files(working_files, config, index, args.jobs, changed, entries)
 
-    if unchanged_files == working_files and not deleted_files:
+    if len(unchanged_files) == len(working_files) and not deleted_files:
         print("No files have been changed and therefore there is nothing to commit.")
         sys.exit(1)
 
     print_file_status(working_files, unchanged_files, deleted_files, config, 'commit')
 
-    create_commit_subdir(
+    changes = store_changes(
         working_files=working_files,
         unchanged_files=unchanged_files,
         deleted_files=deleted_files,
-        to_ignore=args.ignore,
-        config=config
+        file_hashes=file_hashes,
+        config=config,
+        index=index,
+        jobs=args.jobs,
+        entries=entries
     )
 
-    config['last_commit']['value'] = new_commit_value
-    config['last_commit']['user'] = config['user']
-    update_config_file(config)
+    with repository_lock():
+        # another commit or fetch may have finished while the objects were being stored
+        current = read_config_file()
+        if current['last_commit'] != config['last_commit'] or current['user'] != config['user']:
+            print('Commit {} was created while this commit was being prepared. Run commit again.'.format(
+                format_commit_tag(current['last_commit']['value'], current['last_commit']['user'])))
+            sys.exit(1)
+        if missing_change_objects(changes):
+            print('Objects of this commit were removed by a concurrent gc. Run commit again.')
+            sys.exit(1)
+        create_commit_subdir(changes, current)
+
+        current['last_commit']['value'] = new_commit_value
+        current['last_commit']['user'] = current['user']
+        update_config_file(current)
+        update_commit_graph()
+    write_index(index, working_files)
     print('Changes successfully commited, on tag {}'.format(new_commit_tag))
 
 
@@ -334,12 +3418,21 @@ def create_command(args):
         if exception.errno != errno.EEXIST:
             raise
 
+    try:
+        os.makedirs(OBJECTS_PATH)
+    except OSError as exception:
+        if exception.errno != errno.EEXIST:
+            raise
+
     CONFIG_PATH = "{}/config.json".format(VCS_PATH)
 
     config = {
         'repo_name': repo_name,
         'user': username,
         'last_fetch': "NULL",
+        'max_delta_depth': DEFAULT_MAX_DELTA_DEPTH,
+        'storage_mode': args.storage_mode,
+        'chunk_threshold': DEFAULT_CHUNK_THRESHOLD,
         'last_commit': {
             'user': username,
             'value': 0
@@ -348,5 +3441,538 @@ def create_command(args):
     update_config_file(config)
     print('Done - repository intialized and created.')
 
+
+class RepositoryError(Exception):
+    pass
+
+
+_repository_lock = threading.RLock()
+
+
+class Repository(object):
+    # keeps a repository loaded in one process; config, manifests, trees, packs and the index
+    # stay cached between calls and are only re-read when their files change
+
+    def __init__(self, path='.'):
+        self.path = os.path.abspath(path)
+        if not os.path.isdir(os.path.join(self.path, VCS_PATH)):
+            raise RepositoryError('{} is not a vcontrol repository'.format(self.path))
+        self._config = None
+        self._config_key = None
+
+    @contextlib.contextmanager
+    def active(self):
+        # every path in the module is relative to the working directory, so calls are serialized
+        with _repository_lock:
+            previous = os.getcwd()
+            os.chdir(self.path)
+            try:
+                yield self
+            finally:
+                os.chdir(previous)
+
+    def _capture(self, func, *args):
+        output = io.StringIO()
+        code = 0
+        with self.active(), contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                func(*args)
+            except SystemExit as exception:
+                code = exception.code if isinstance(exception.code, int) else 1
+        return code, output.getvalue()
+
+    @property
+    def config(self):
+        with self.active():
+            stat = os.stat(CONFIG_PATH)
+            key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            if key != self._config_key:
+                self._config = read_config_file()
+                self._config_key = key
+            return self._config
+
+    @property
+    def head(self):
+        config = self.config
+        return format_commit_tag(config['last_commit']['value'], config['last_commit']['user'])
+
+    def run(self, argv):
+        # parsed inside _capture, so usage errors reach the caller rather than the daemon's stderr
+        return self._capture(self._run, argv)
+
+    def _run(self, argv):
+        args = parse_command_line(build_parser(), argv)
+        if not hasattr(args, 'func'):
+            print('no command given')
+            sys.exit(1)
+        run_command(args)
+
+    def status(self, jobs=DEFAULT_JOBS):
+        with self.active():
+            config = self.config
+            index = read_index()
+            working_files, changed, entries = scan_working_files(index, ['.vcs'])
+            unchanged_files, deleted_files, _ = get_unchanged_deleted_files(working_files, config, index, jobs, changed, entries)
+            write_index(index, working_files)
+            manifest = {}
+            if config['last_commit']['value'] > 0:
+                manifest = load_manifest(self.head)
+        unchanged = set(unchanged_files)
+        return {
+            'commit': self.head,
+            'added': sorted(file for file in working_files if file not in manifest),
+            'changed': sorted(file for file in working_files if file in manifest and file not in unchanged),
+            'deleted': sorted(deleted_files)
+        }
+
+    def info(self):
+        return self.run(['info'])
+
+    def log(self, path=None, all=False, max_count=None):
+        argv = ['log']
+        if path is not None:
+            argv.append(path)
+        if all:
+            argv.append('--all')
+        if max_count is not None:
+            argv += ['--max-count', str(max_count)]
+        return self.run(argv)
+
+    def commit(self, ignore=None, jobs=DEFAULT_JOBS):
+        return self.run(['commit', '--jobs', str(jobs)] + (['--ignore'] + list(ignore) if ignore else []))
+
+    def fetch(self, source, revert_latest=False, depth=None, lazy=False, check=False):
+        return self.run(['fetch', source] + (['--revert-latest'] if revert_latest else [])
+                        + (['--depth', str(depth)] if depth is not None else []) + (['--lazy'] if lazy else [])
+                        + (['--check'] if check else []))
+
+    def revert(self, commit_tag, paths=None):
+        # skips the interactive confirmation of the command line
+        return self._capture(self._locked_revert, commit_tag, paths)
+
+    def _locked_revert(self, commit_tag, paths):
+        with repository_lock():
+            revert(commit_tag, WORKING_DIR, COMMITS_PATH, paths)
+
+    def export(self, commit_tag, output, paths=None, archive_format=None):
+        # output is a file; stdout is captured as text here
+        return self.run(['export', commit_tag] + list(paths or []) + ['--output', output]
+                        + (['--format', archive_format] if archive_format else []))
+
+    def repack(self, all=False, depth=None):
+        return self.run(['repack'] + (['--all'] if all else []) + (['--depth', str(depth)] if depth is not None else []))
+
+    def fsck(self, jobs=DEFAULT_JOBS):
+        return self.run(['fsck', '--no-progress', '--jobs', str(jobs)])
+
+    def gc(self, keep=None, since=None, prune_now=False):
+        return self.run(['gc'] + (['--keep', str(keep)] if keep is not None else [])
+                        + (['--since', since] if since is not None else []) + (['--prune-now'] if prune_now else []))
+
+
+def run_batch_item(path, command, argv):
+    # runs in a pool process; any failure is reported in the result, so one repository cannot stop the rest
+    start = time.time()
+    result = {'repo': path, 'command': command}
+    try:
+        repository = Repository(path)
+        if command == 'info':
+            # the parallelism is across repositories, so each one is scanned with a single thread
+            result.update(repository.status(jobs=1))
+            result['code'] = 0
+        else:
+            result['code'], result['output'] = repository.run([command] + argv)
+    except Exception as exception:
+        result['code'] = 1
+        result['error'] = '{}: {}'.format(type(exception).__name__, exception)
+    result['ok'] = result['code'] == 0
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+def read_repository_list(source):
+    # a file with one directory per line (- for stdin), otherwise a glob matching repository directories
+    if source == '-' or os.path.isfile(source):
+        with (contextlib.nullcontext(sys.stdin) if source == '-' else open(source, 'r')) as f:
+            paths = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    else:
+        paths = [path for path in sorted(glob.glob(os.path.expanduser(source), recursive=True)) if os.path.isdir(path)]
+    return list(dict.fromkeys(os.path.abspath(os.path.expanduser(path)) for path in paths))
+
+
+def batch_command(args):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    paths = read_repository_list(args.repos_from)
+    if not paths:
+        print('No repositories found in {}.'.format(args.repos_from))
+        sys.exit(1)
+
+    argv = list(args.args)
+    if args.batch_command == 'commit':
+        # a later --jobs in argv still wins
+        argv = ['--jobs', '1'] + argv
+    elif args.batch_command == 'fetch' and argv and not argv[0].startswith(('tcp://', '-')):
+        # every command runs inside its own repository, so a source directory is made absolute first
+        argv[0] = os.path.abspath(argv[0])
+
+    start = time.time()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(paths)))) as executor:
+        futures = dict((executor.submit(run_batch_item, path, args.batch_command, argv), path) for path in paths)
+        # results are printed as they finish, so a slow repository does not hold back the others
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as exception:
+                # the worker process itself died
+                result = {'repo': futures[future], 'command': args.batch_command, 'code': 1, 'ok': False,
+                          'error': '{}: {}'.format(type(exception).__name__, exception)}
+            failed += not result['ok']
+            print(json.dumps(result, sort_keys=True))
+            sys.stdout.flush()
+    print('{} repositories, {} failed, {:.2f}s'.format(len(paths), failed, time.time() - start), file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+def send_request(socket_path, message):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(message).encode() + b'\n')
+        with client.makefile('rb') as f:
+            line = f.readline()
+    finally:
+        client.close()
+    if not line:
+        raise ConnectionError('{} closed the connection'.format(socket_path))
+    return json.loads(line.decode())
+
+
+def stop_socket_server(socket_path, name):
+    try:
+        send_request(socket_path, {'cmd': 'stop'})
+    except (OSError, ValueError):
+        print('No {} is running.'.format(name))
+        sys.exit(1)
+    print('{} stopped.'.format(name.capitalize()))
+
+
+def claim_socket_path(socket_path, name):
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+        print('A {} is already running on {}'.format(name, socket_path))
+        sys.exit(1)
+    except OSError:
+        # left behind by a process that did not shut down cleanly
+        os.remove(socket_path)
+    finally:
+        probe.close()
+
+
+def forward_to_daemon(argv):
+    response = send_request(DAEMON_SOCKET_PATH, {'argv': argv})
+    sys.stdout.write(response['output'])
+    return response['code']
+
+
+async def serve_daemon_client(repository, stop, reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            request = json.loads(line.decode())
+            if request.get('cmd') == 'stop':
+                send_message(writer, {'code': 0, 'output': 'daemon stopped.\n'})
+                await writer.drain()
+                stop.set()
+                break
+            argv = request.get('argv') or []
+            if not argv or argv[0] not in DAEMON_COMMANDS:
+                send_message(writer, {'code': 1, 'output': 'daemon does not run {}\n'.format(' '.join(argv))})
+            else:
+                # requests run one at a time on the event loop, as they share the working directory
+                code, output = repository.run(argv)
+                send_message(writer, {'code': code, 'output': output})
+            await writer.drain()
+    except (ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_daemon(repository):
+    import asyncio
+    stop = asyncio.Event()
+    server = await asyncio.start_unix_server(
+        functools.partial(serve_daemon_client, repository, stop), DAEMON_SOCKET_PATH)
+    print('daemon for {} listening on {}'.format(repository.config['repo_name'], DAEMON_SOCKET_PATH))
+    sys.stdout.flush()
+    async with server:
+        await stop.wait()
+
+
+def daemon_command(args):
+    import asyncio
+    if not os.path.exists(VCS_PATH):
+        print("Repository has not been intialized, or isn't detected. Run 'vcontrol create [repo_name] [username]'")
+        sys.exit(1)
+
+    if args.stop:
+        stop_socket_server(DAEMON_SOCKET_PATH, 'daemon')
+        return
+    claim_socket_path(DAEMON_SOCKET_PATH, 'daemon')
+
+    repository = Repository(WORKING_DIR)
+    try:
+        asyncio.run(serve_daemon(repository))
+    except KeyboardInterrupt:
+        print('daemon stopped.')
+    finally:
+        if os.path.exists(DAEMON_SOCKET_PATH):
+            os.remove(DAEMON_SOCKET_PATH)
+
+
+class TreeMonitor(object):
+    # hands out tokens of the form session:sequence; a new session (restart or overflow) makes
+    # every earlier token invalid, and clients then fall back to a full scan
+
+    def __init__(self, root):
+        self.root = root
+        self.dirty = {}
+        self.sequence = 0
+        self.reset()
+
+    def reset(self):
+        import uuid
+        self.session = uuid.uuid4().hex
+        self.dirty.clear()
+
+    def token(self):
+        return '{}:{}'.format(self.session, self.sequence)
+
+    def mark(self, path):
+        if path == './.vcs' or path.startswith('./.vcs/'):
+            return
+        self.sequence += 1
+        self.dirty[path] = self.sequence
+
+    def sync(self):
+        pass
+
+    def changes(self, since):
+        self.sync()
+        session, _, sequence = (since or '').partition(':')
+        if session != self.session:
+            return {'token': self.token(), 'full': True}
+        sequence = int(sequence)
+        return {'token': self.token(), 'paths': sorted(path for path, seen in self.dirty.items() if seen > sequence)}
+
+    def close(self):
+        pass
+
+
+class InotifyMonitor(TreeMonitor):
+
+    def __init__(self, root):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.add_watch_call = libc.inotify_add_watch
+        self.add_watch_call.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.rm_watch_call = libc.inotify_rm_watch
+        self.rm_watch_call.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        self.paths = {}
+        TreeMonitor.__init__(self, root)
+        self.watch_tree(root)
+
+    def watch_tree(self, directory):
+        # ignored subtrees (build output, node_modules) get no watches
+        import ctypes
+        ignored = read_ignore_file()
+        for dirpath, dirnames, _ in os.walk(directory, topdown=True):
+            dirnames[:] = [d for d in dirnames if d != '.vcs'
+                           and (ignored is None or not ignored(os.path.join(dirpath, d), True, False))]
+            wd = self.add_watch_call(self.fd, os.fsencode(dirpath), IN_WATCH_MASK)
+            if wd < 0:
+                # usually fs.inotify.max_user_watches, so events for this tree would be lost
+                raise OSError(ctypes.get_errno(), 'cannot watch {}'.format(dirpath))
+            self.watches[wd] = dirpath
+            self.paths[dirpath] = wd
+
+    def unwatch_tree(self, directory):
+        for path in [p for p in self.paths if p == directory or p.startswith(directory + '/')]:
+            wd = self.paths.pop(path)
+            self.watches.pop(wd, None)
+            self.rm_watch_call(self.fd, wd)
+
+    def sync(self):
+        # drains queued events so a client never gets an answer older than its request
+        while True:
+            try:
+                data = os.read(self.fd, BLOCK_SIZE)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                self.handle_event(wd, mask, name)
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            count('monitor overflows')
+            self.reset()
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            if self.paths.get(directory) == wd:
+                self.paths.pop(directory)
+            return
+        if not name:
+            return
+        path = os.path.join(directory, name)
+        self.mark(path)
+        if path == IGNORE_PATH:
+            # the set of watched directories depends on the ignore file
+            self.unwatch_tree(self.root)
+            self.reset()
+            try:
+                self.watch_tree(self.root)
+            except OSError:
+                pass
+            return
+        if mask & IN_ISDIR:
+            if mask & (IN_MOVED_FROM | IN_DELETE):
+                self.unwatch_tree(path)
+            if mask & (IN_CREATE | IN_MOVED_TO) and name != '.vcs':
+                try:
+                    self.watch_tree(path)
+                except OSError:
+                    self.reset()
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollMonitor(TreeMonitor):
+
+    def __init__(self, root, interval=DEFAULT_POLL_INTERVAL):
+        self.interval = interval
+        self.snapshot = {}
+        TreeMonitor.__init__(self, root)
+        self.sync()
+
+    def sync(self):
+        # without kernel events a request has to rescan, but only stats are needed, never hashes
+        snapshot = {}
+        for file in get_file_paths(self.root, ['.vcs']):
+            try:
+                stat = os.lstat(file)
+            except OSError:
+                continue
+            snapshot[file] = (stat.st_mtime_ns, stat.st_size, stat.st_ino, stat.st_ctime_ns)
+        for file in snapshot.keys() - self.snapshot.keys():
+            self.mark(file)
+        for file, signature in self.snapshot.items():
+            if snapshot.get(file) != signature:
+                self.mark(file)
+        self.snapshot = snapshot
+
+
+async def serve_monitor_client(monitor, stop, reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            request = json.loads(line.decode())
+            if request.get('cmd') == 'stop':
+                send_message(writer, {'stopped': True})
+                await writer.drain()
+                stop.set()
+                break
+            elif request.get('cmd') == 'changes':
+                send_message(writer, monitor.changes(request.get('since')))
+            else:
+                send_message(writer, {'error': 'unknown request'})
+            await writer.drain()
+    except (ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def poll_monitor(monitor):
+    import asyncio
+    while True:
+        await asyncio.sleep(monitor.interval)
+        monitor.sync()
+
+
+async def serve_monitor(monitor):
+    import asyncio
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    if isinstance(monitor, InotifyMonitor):
+        loop.add_reader(monitor.fd, monitor.sync)
+    else:
+        poller = loop.create_task(poll_monitor(monitor))
+    server = await asyncio.start_unix_server(
+        functools.partial(serve_monitor_client, monitor, stop), MONITOR_SOCKET_PATH)
+    print('monitoring {} with {} on {}'.format(
+        os.path.abspath(monitor.root), 'inotify' if isinstance(monitor, InotifyMonitor) else 'polling', MONITOR_SOCKET_PATH))
+    sys.stdout.flush()
+    async with server:
+        await stop.wait()
+    if isinstance(monitor, InotifyMonitor):
+        loop.remove_reader(monitor.fd)
+    else:
+        poller.cancel()
+
+
+def monitor_command(args):
+    import asyncio
+    if not os.path.exists(VCS_PATH):
+        print("Repository has not been intialized, or isn't detected. Run 'vcontrol create [repo_name] [username]'")
+        sys.exit(1)
+
+    if args.stop:
+        stop_socket_server(MONITOR_SOCKET_PATH, 'monitor')
+        return
+    claim_socket_path(MONITOR_SOCKET_PATH, 'monitor')
+
+    monitor = None
+    if not args.poll and sys.platform.startswith('linux'):
+        try:
+            monitor = InotifyMonitor(WORKING_DIR)
+        except (OSError, AttributeError) as exception:
+            print('inotify is unavailable ({}), falling back to polling.'.format(exception))
+    if monitor is None:
+        monitor = PollMonitor(WORKING_DIR, args.interval)
+
+    try:
+        asyncio.run(serve_monitor(monitor))
+    except KeyboardInterrupt:
+        print('monitor stopped.')
+    finally:
+        monitor.close()
+        if os.path.exists(MONITOR_SOCKET_PATH):
+            os.remove(MONITOR_SOCKET_PATH)
+
+
 if __name__ == "__main__":
     main()